@@ -0,0 +1,134 @@
+import argparse, json, multiprocessing, os, resource, sys, tempfile, time
+import redis
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from standInServer import SyntheticCatalog, StandInServer, escape
+
+BF = 'http://id.loc.gov/ontologies/bibframe/'
+HOSTS = ['id.loc.gov','www.wikidata.org','query.wikidata.org']
+
+# Write a BIBFRAME file of synthetic Works, each followed by its Instances. Contributors have
+# example.org URIs, so their names are looked up in LCNAF first, and a WorldCat Entity URI in
+# their MARC key, so they can be found in Wikidata.
+def generateInput(path,catalog,args):
+	with open(path,'w',encoding='utf-8') as out:
+		out.write('<?xml version="1.0" encoding="UTF-8"?>\n<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#" xmlns:bf="http://id.loc.gov/ontologies/bibframe/" xmlns:bflc="http://id.loc.gov/ontologies/bflc/">\n')
+		for i in range(args.works):
+			title = catalog.getWorkTitle(i)
+			parts = [f'<bf:Work rdf:about="http://example.org/{i}#Work"><rdf:type rdf:resource="{BF}Text"/>']
+			parts.append(f'<bf:title><bf:Title><bf:mainTitle>{escape(title)}</bf:mainTitle></bf:Title></bf:title>')
+			for v in range(args.variants):
+				parts.append(f'<bf:title><bf:VariantTitle><bf:mainTitle>{escape(title)} : version {v + 1}</bf:mainTitle></bf:VariantTitle></bf:title>')
+			parts.append('<bf:language rdf:resource="http://id.loc.gov/vocabulary/languages/eng"/>')
+			for n in range(args.notes):
+				parts.append(f'<bf:note><bf:Note><rdfs:label>Note {n} about {escape(title)}</rdfs:label></bf:Note></bf:note>')
+			for c, j in enumerate(catalog.getWorkNames(i,args.contributors)):
+				name = catalog.getName(j)
+				contribution_type = f'<rdf:type rdf:resource="{BF}PrimaryContribution"/>' if c == 0 else ''
+				parts.append(f'<bf:contribution><bf:Contribution>{contribution_type}<bf:agent><bf:Agent rdf:about="http://example.org/{i}#Agent{c}"><rdf:type rdf:resource="{BF}Person"/><rdfs:label>{escape(name)}</rdfs:label><bflc:marcKey>1001 $a{escape(name)}$1https://id.oclc.org/worldcat/entity/{catalog.getOCLCId(j)}</bflc:marcKey></bf:Agent></bf:agent></bf:Contribution></bf:contribution>')
+			parts.append('</bf:Work>\n')
+			for n in range(args.instances):
+				parts.append(f'<bf:Instance rdf:about="http://example.org/{i}#Instance{n}"><bf:instanceOf rdf:resource="http://example.org/{i}#Work"/><bf:title><bf:Title><bf:mainTitle>{escape(title)}</bf:mainTitle></bf:Title></bf:title></bf:Instance>\n')
+			out.write(''.join(parts))
+		out.write('</rdf:RDF>\n')
+
+# Runs the stand-in server in its own process, so that its work isn't counted against the
+# reconciliation's time or memory, and sends back its counts once told to stop
+def serve(args,connection):
+	catalog = SyntheticCatalog(args.seed,args.works,args.titles,args.names,args.results,args.wikidata_works)
+	server = StandInServer(catalog,args.latency,args.throttle,args.retry_after,0,args.seed)
+	server.start()
+	connection.send({ host: server.getBaseUrl(host) for host in HOSTS })
+	connection.recv()
+	server.stop()
+	connection.send(server.stats)
+
+def writeConfig(path,args,base_urls):
+	with open(path,'w') as config:
+		config.write(f"[redis]\nhost = {args.redis_host}\nport = {args.redis_port}\nloc_db = {args.redis_db}\nwiki_db = {args.redis_db}\n\n")
+		config.write("[rate_limits]\n" + "".join(f"{host} = {args.rate_limit}\n" for host in HOSTS) + "\n")
+		config.write("[host_overrides]\n" + "".join(f"{host} = {base_url}\n" for host, base_url in base_urls.items()) + "\n")
+		if args.config:
+			with open(args.config) as extra_config:
+				config.write(extra_config.read())
+
+# Generate an input, reconcile it against the stand-in server, and report the throughput as
+# JSON so that results can be compared across releases
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument("source", choices=['loc','wikidata'], help="Run queries on LOC or Wikidata")
+	parser.add_argument("--works", type=int, default=200, help="Number of Works in the generated input")
+	parser.add_argument("--variants", type=int, default=1, help="Variant titles on each Work")
+	parser.add_argument("--notes", type=int, default=1, help="Notes on each Work")
+	parser.add_argument("--contributors", type=int, default=1, help="Contributors on each Work")
+	parser.add_argument("--instances", type=int, default=1, help="Instances of each Work")
+	parser.add_argument("--titles", type=int, default=0, help="Number of distinct titles, defaults to a quarter of the Works")
+	parser.add_argument("--names", type=int, default=0, help="Number of distinct contributor names, defaults to a tenth of the Works")
+	parser.add_argument("--results", type=int, default=5, help="Number of results on each search page")
+	parser.add_argument("--wikidata-works", type=int, default=200, help="Number of works listed for each contributor in Wikidata")
+	parser.add_argument("--latency", type=float, default=0.0, help="Seconds the server waits before answering each request")
+	parser.add_argument("--throttle", type=float, default=0.0, help="Share of requests the server answers with a 429")
+	parser.add_argument("--retry-after", type=int, default=1, help="Seconds given in the Retry-After header of a 429")
+	parser.add_argument("--rate-limit", default="100000/second", help="Rate limit used for each host")
+	parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic titles and names")
+	parser.add_argument("-w", "--workers", type=int, default=1, help="Number of Works to reconcile concurrently")
+	parser.add_argument("-s", "--stream", action="store_true", help="Process the input incrementally")
+	parser.add_argument("--config", help="Extra application.config sections to run with, such as candidate_pruning or scheduling")
+	parser.add_argument("--redis-host", default="localhost")
+	parser.add_argument("--redis-port", type=int, default=6379)
+	parser.add_argument("--redis-db", type=int, default=15, help="Redis database to use, which is emptied before the run")
+	parser.add_argument("--keep-cache", action="store_true", help="Don't empty the Redis database before the run")
+	parser.add_argument("-o", "--output", help="File to write the report to, instead of printing it")
+	args = parser.parse_args()
+	args.titles = args.titles or max(args.works // 4,1)
+	args.names = args.names or max(args.works // 10,1)
+
+	work_directory = tempfile.mkdtemp(prefix='reconciliation-benchmark-')
+	input_path = os.path.join(work_directory,'benchmark.xml')
+	generate_start = time.perf_counter()
+	generateInput(input_path,SyntheticCatalog(args.seed,args.works,args.titles,args.names,args.results,args.wikidata_works),args)
+	generate_seconds = time.perf_counter() - generate_start
+
+	connection, server_connection = multiprocessing.Pipe()
+	server_process = multiprocessing.Process(target=serve,args=(args,server_connection),daemon=True)
+	server_process.start()
+	base_urls = connection.recv()
+
+	writeConfig(os.path.join(work_directory,'application.config'),args,base_urls)
+	if not args.keep_cache:
+		redis.Redis(host=args.redis_host,port=args.redis_port,db=args.redis_db).flushdb()
+
+	os.chdir(work_directory)
+	import reconcileWorks
+	os.makedirs(os.path.join(work_directory,'output'))
+	run_args = argparse.Namespace(input=input_path,output=os.path.join(work_directory,'output'),source=reconcileWorks.Sources(args.source),verbose=False,workers=args.workers,stream=args.stream,resume=False,catalog=reconcileWorks.Catalogs.loc)
+
+	start = time.perf_counter()
+	reconcileWorks.reconcileWorks(run_args)
+	elapsed = time.perf_counter() - start
+
+	connection.send('stop')
+	server_stats = connection.recv()
+	server_process.join()
+
+	requests = sum(server_stats['requests'].values()) + server_stats['throttled']
+	report = {
+		'source': args.source,
+		'parameters': { key: value for key, value in vars(args).items() if key not in ['source','output','redis_host','redis_port','redis_db'] },
+		'works': args.works,
+		'seconds': elapsed,
+		'works_per_second': args.works / elapsed if elapsed > 0 else 0,
+		'requests': requests,
+		'requests_per_work': requests / args.works,
+		'requests_by_kind': server_stats['requests'],
+		'throttled': server_stats['throttled'],
+		'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+		'stage_seconds': dict({ 'generate_input': generate_seconds }, **reconcileWorks.run_metrics.getTotals())
+	}
+
+	if args.output:
+		with open(args.output,'w') as report_file:
+			json.dump(report,report_file,indent='\t')
+	else:
+		print(json.dumps(report,indent='\t'))
@@ -0,0 +1,254 @@
+import argparse, http.server, json, random, re, threading, time, urllib.parse, zlib
+
+# Synthetic records shared by the benchmark's input and the stand-in server. Title i and name j
+# are always the same for the same seed, so the server can answer with records that match the
+# Works in a generated input without having seen it.
+WORDS = ['symphony','sonata','quartet','concerto','songs','dances','variations','suite','mass','requiem','preludes','fugues','etudes','nocturnes','waltzes','marches','overture','serenade','fantasia','rhapsody','trio','quintet','madrigals','motets','cantata','oratorio','opera','ballet','music','pieces','studies','sketches','river','night','spring','winter','sea','mountain','garden','city','love','death','light','shadow','dreams','memories','voices','bells','journey','home']
+SYLLABLES = ['ba','be','bro','ca','chi','da','de','fa','ga','hen','ka','ler','ma','mo','na','ni','pe','ra','ri','sa','schu','sto','ta','ti','va','ve','wa','zi']
+
+class SyntheticCatalog:
+	def __init__(self,seed,works,titles,names,results,wikidata_works):
+		self.seed = seed
+		self.works = works
+		self.titles = titles
+		self.names = names
+		self.results = results
+		self.wikidata_works = wikidata_works
+		self.lock = threading.Lock()
+		self.searched = {}
+
+	def getTitle(self,i):
+		rng = random.Random(self.seed * 1000003 + i)
+		words = [rng.choice(WORDS) for _ in range(rng.randint(2,5))]
+		return ' '.join(words).capitalize() + f" no. {i}"
+
+	def getName(self,j):
+		rng = random.Random(self.seed * 1000033 + j)
+		surname = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2,3))).capitalize()
+		given = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2,3))).capitalize()
+		return f"{surname}{j}, {given}"
+
+	def getOCLCId(self,j):
+		return f"E39PBJ{j:08d}"
+
+	# The title and the names of the contributors of Work i in a generated input
+	def getWorkTitle(self,i):
+		return self.getTitle(i % self.titles)
+
+	def getWorkNames(self,i,contributors):
+		return [(i * 7 + c) % self.names for c in range(contributors)]
+
+	# Searches are answered with the searched text as the first heading, followed by near
+	# misses. The text is remembered under the key used in the result links, so the records
+	# fetched from those links can carry the same title.
+	def search(self,text):
+		key = zlib.crc32(text.encode('utf-8'))
+		with self.lock:
+			self.searched[key] = text
+		return key
+
+	def getSearchedText(self,key):
+		with self.lock:
+			return self.searched.get(key,f"Unknown title {key}")
+
+	def getContributorTitles(self,j):
+		titles = [self.getWorkTitle(i) for i in range(self.works) if (i * 7) % self.names == j]
+		return titles + [self.getTitle(self.titles + j * self.wikidata_works + k) for k in range(max(self.wikidata_works - len(titles),0))]
+
+def escape(text):
+	return text.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;').replace('"','&quot;')
+
+RDF_ROOT = '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#" xmlns:bf="http://id.loc.gov/ontologies/bibframe/" xmlns:madsrdf="http://www.loc.gov/mads/rdf/v1#">'
+
+# Builds responses shaped like the ones from id.loc.gov, the Wikidata API and the Wikidata
+# SPARQL endpoint. Each returns a status, content type and body, along with the kind of
+# request it was for the server's counts.
+class StandInResponses:
+	def __init__(self,catalog):
+		self.catalog = catalog
+
+	def respond(self,host,path,query):
+		params = urllib.parse.parse_qs(query)
+		if host == 'id.loc.gov':
+			if path.startswith('/search/'):
+				return ('search',) + self.searchPage(params['q'])
+			match = re.fullmatch(r'/resources/(works|hubs)/(\d+)x(\d+)\.bibframe\.rdf',path)
+			if match:
+				return ('record',) + self.workRecord(match.group(1),int(match.group(2)),int(match.group(3)))
+			match = re.fullmatch(r'/authorities/names/n(\d+)x(\d+)\.marcxml\.xml',path)
+			if match:
+				return ('name_record',) + self.nameRecord(int(match.group(1)),int(match.group(2)))
+			match = re.fullmatch(r'/rwo/agents/n(\d+)\.rdf',path)
+			if match:
+				return ('agent',) + self.agentRecord(int(match.group(1)))
+		elif host == 'query.wikidata.org' and path.startswith('/bigdata/namespace/wdq/sparql'):
+			return ('sparql',) + self.sparqlResults(params['query'][0])
+		elif host == 'www.wikidata.org' and path.startswith('/w/api.php'):
+			return ('wikidata_search',) + self.wikidataSearch(params['srsearch'][0])
+
+		return 'unknown', 404, 'text/html', '<html><body>Not found</body></html>'
+
+	def searchPage(self,q):
+		text = q[0].split(' rdftype:')[0]
+		scheme = q[1] if len(q) > 1 else ''
+		if 'names' in scheme:
+			link_prefix = '/authorities/names/n'
+		elif 'hubs' in scheme:
+			link_prefix = '/resources/hubs/'
+		else:
+			link_prefix = '/resources/works/'
+
+		key = self.catalog.search(text)
+		rows = []
+		for k in range(self.catalog.results):
+			heading = text if k == 0 else f"{text} {k}"
+			rows.append(f'<tr><td><a href="{link_prefix}{key}x{k}">{escape(heading)}</a></td><td>Work</td></tr>')
+			rows.append(f'<tr><td colspan="5">{escape(heading)} (variant); {escape(heading.upper())}</td></tr>')
+		return 200, 'text/html; charset=utf-8', f'<html><body><table class="id-std"><tbody>{"".join(rows)}</tbody></table></body></html>'
+
+	def workRecord(self,kind,key,k):
+		text = self.catalog.getSearchedText(key)
+		title = text if k == 0 else f"{text} {k}"
+		name_index = key % self.catalog.names
+		if kind == 'works':
+			links = f'<bf:expressionOf rdf:resource="http://id.loc.gov/resources/hubs/{key}x{k}"/>'
+		else:
+			links = f'<bf:hasExpression rdf:resource="http://id.loc.gov/resources/works/{key}x{k}"/>'
+		body = f'''<?xml version="1.0" encoding="UTF-8"?>
+{RDF_ROOT}<bf:Work rdf:about="http://id.loc.gov/resources/{kind}/{key}x{k}">
+<rdf:type rdf:resource="http://id.loc.gov/ontologies/bibframe/Text"/>
+<bf:title><bf:Title><bf:mainTitle>{escape(title)}</bf:mainTitle></bf:Title></bf:title>
+<bf:title><bf:VariantTitle><bf:mainTitle>{escape(title.upper())}</bf:mainTitle></bf:VariantTitle></bf:title>
+<bf:language rdf:resource="http://id.loc.gov/vocabulary/languages/eng"/>
+<bf:contribution><bf:Contribution><rdf:type rdf:resource="http://id.loc.gov/ontologies/bibframe/PrimaryContribution"/><bf:agent rdf:resource="http://id.loc.gov/rwo/agents/n{name_index}"/></bf:Contribution></bf:contribution>
+<bf:contribution><bf:Contribution><bf:agent><bf:Agent><rdfs:label>{escape(self.catalog.getName(name_index + 1))}</rdfs:label></bf:Agent></bf:agent></bf:Contribution></bf:contribution>
+<bf:note><bf:Note><rdfs:label>Note 0 about {escape(text)}</rdfs:label></bf:Note></bf:note>
+{links}
+</bf:Work></rdf:RDF>'''
+		return 200, 'application/rdf+xml', body
+
+	def nameRecord(self,key,k):
+		name = self.catalog.getSearchedText(key)
+		if k > 0:
+			name = f"{name} ({k})"
+		return 200, 'application/xml', f'<record xmlns="http://www.loc.gov/MARC21/slim"><datafield tag="100" ind1="1" ind2=" "><subfield code="a">{escape(name)}</subfield></datafield></record>'
+
+	def agentRecord(self,j):
+		return 200, 'application/rdf+xml', f'{RDF_ROOT}<madsrdf:RWO rdf:about="http://id.loc.gov/rwo/agents/n{j}"><rdfs:label>{escape(self.catalog.getName(j))}</rdfs:label></madsrdf:RWO></rdf:RDF>'
+
+	def sparqlResults(self,query):
+		entity = 'http://www.wikidata.org/entity/'
+		values = re.search(r'VALUES [^{]*\{(.*?)\}',query,re.S)
+		values = values.group(1) if values else ''
+		bindings = []
+		if 'P10832' in query:
+			for oclc_id in re.findall(r'"E39PBJ(\d+)"',values):
+				bindings.append({ 'contrib': { 'type': 'uri', 'value': f"{entity}Q{int(oclc_id)}" }, 'oclc_id': { 'type': 'literal', 'value': f"E39PBJ{oclc_id}" } })
+		elif 'P106' in query:
+			for j in re.findall(r'wd:Q(\d+)',values):
+				bindings.append({ 'contrib': { 'type': 'uri', 'value': f"{entity}Q{j}" }, 'occupation_properties': { 'type': 'uri', 'value': f"{entity}P86" } })
+		else:
+			for j, occupation_property in re.findall(r'\(wd:Q(\d+) wdt:(\w+)\)',values):
+				for k, title in enumerate(self.catalog.getContributorTitles(int(j))):
+					bindings.append({ 'contrib': { 'type': 'uri', 'value': f"{entity}Q{j}" }, 'works': { 'type': 'uri', 'value': f"{entity}Q{j}{k:06d}" }, 'worksLabel': { 'type': 'literal', 'value': title } })
+		return 200, 'application/sparql-results+json', json.dumps({ 'head': { 'vars': [] }, 'results': { 'bindings': bindings } })
+
+	def wikidataSearch(self,name):
+		match = re.search(r'(\d+),',name)
+		results = [{ 'title': f"Q{match.group(1)}" }] if match else []
+		return 200, 'application/json', json.dumps({ 'query': { 'search': results } })
+
+# Serves the stand-in responses under a path prefix for each host, so that requests for
+# https://id.loc.gov/search/ are made to http://<server>/id.loc.gov/search/. Every response is
+# delayed by the configured latency, and a share of requests can be answered with a 429 and a
+# Retry-After header instead.
+class StandInServer:
+	def __init__(self,catalog,latency=0.0,throttle=0.0,retry_after=1,port=0,seed=0):
+		self.responses = StandInResponses(catalog)
+		self.latency = latency
+		self.throttle = throttle
+		self.retry_after = retry_after
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.stats = { 'requests': {}, 'throttled': 0 }
+
+		stand_in = self
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			disable_nagle_algorithm = True
+
+			def do_GET(self):
+				stand_in.handle(self)
+
+			def log_message(self,format,*args):
+				pass
+
+		self.server = http.server.ThreadingHTTPServer(('127.0.0.1',port),Handler)
+		self.server.daemon_threads = True
+
+	def getBaseUrl(self,host):
+		return f"http://127.0.0.1:{self.server.server_address[1]}/{host}"
+
+	def count(self,kind):
+		with self.lock:
+			self.stats['requests'][kind] = self.stats['requests'].get(kind,0) + 1
+
+	def handle(self,request):
+		if self.latency > 0:
+			time.sleep(self.latency)
+
+		url = urllib.parse.urlsplit(request.path)
+		host, path = url.path.lstrip('/').split('/',1) if '/' in url.path.lstrip('/') else (url.path.lstrip('/'), '')
+		with self.lock:
+			throttled = self.throttle > 0 and self.random.random() < self.throttle
+			if throttled:
+				self.stats['throttled'] += 1
+
+		if throttled:
+			status, content_type, body, headers = 429, 'text/plain', 'Too Many Requests', { 'Retry-After': str(self.retry_after) }
+		else:
+			kind, status, content_type, body = self.responses.respond(host,f"/{path}",url.query)
+			headers = {}
+			self.count(kind)
+
+		content = body.encode('utf-8')
+		request.send_response(status)
+		request.send_header('Content-Type',content_type)
+		request.send_header('Content-Length',str(len(content)))
+		for header, value in headers.items():
+			request.send_header(header,value)
+		request.end_headers()
+		request.wfile.write(content)
+
+	def start(self):
+		self.thread = threading.Thread(target=self.server.serve_forever,daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+# Run the stand-in on its own, for pointing reconcileWorks.py at it through a host_overrides
+# section while trying things out
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-p", "--port", type=int, default=8765, help="Port to listen on")
+	parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic titles and names")
+	parser.add_argument("--works", type=int, default=1000, help="Number of Works in the input the server is answering for")
+	parser.add_argument("--titles", type=int, default=250, help="Number of distinct titles in that input")
+	parser.add_argument("--names", type=int, default=100, help="Number of distinct contributor names in that input")
+	parser.add_argument("--results", type=int, default=5, help="Number of results on each search page")
+	parser.add_argument("--wikidata-works", type=int, default=200, help="Number of works listed for each contributor in Wikidata")
+	parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering each request")
+	parser.add_argument("--throttle", type=float, default=0.0, help="Share of requests answered with a 429")
+	parser.add_argument("--retry-after", type=int, default=1, help="Seconds given in the Retry-After header of a 429")
+	args = parser.parse_args()
+
+	catalog = SyntheticCatalog(args.seed,args.works,args.titles,args.names,args.results,args.wikidata_works)
+	server = StandInServer(catalog,args.latency,args.throttle,args.retry_after,args.port,args.seed)
+	for host in ['id.loc.gov','www.wikidata.org','query.wikidata.org']:
+		print(f"{host} = {server.getBaseUrl(host)}")
+	try:
+		server.server.serve_forever()
+	except KeyboardInterrupt:
+		server.server.server_close()
@@ -0,0 +1,383 @@
+import argparse, logging, gzip, json, re, sqlite3, zlib, collections, datetime
+from lxml import etree
+from reconcileWorks import Namespaces, XPaths, getIndexTerms
+
+RDF_TYPE = f"{Namespaces.RDF}type"
+RDF_FIRST = f"{Namespaces.RDF}first"
+RDF_REST = f"{Namespaces.RDF}rest"
+RDF_NIL = f"{Namespaces.RDF}nil"
+
+# Classes used for the element of a nested node when it has more than one type, in order of
+# preference, so that titles, contributions and notes come out the way id.loc.gov writes them
+NODE_CLASSES = [f"{Namespaces.BF}{x}" for x in ['VariantTitle','Title','Contribution','Note','Agent']]
+
+NAME_ELEMENTS = [f"{Namespaces.MADSRDF}FullNameElement",f"{Namespaces.MADSRDF}NameElement"]
+
+XML_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9._-]*$')
+
+NTRIPLE = re.compile(r'^\s*(<[^>]*>|_:\S+)\s+<([^>]*)>\s+(<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[A-Za-z0-9-]+|\^\^<[^>]*>)?)\s*\.\s*$')
+LITERAL = re.compile(r'^"((?:[^"\\]|\\.)*)"(?:@([A-Za-z0-9-]+)|\^\^<([^>]*)>)?$')
+ESCAPE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+ESCAPES = { 't': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f', '"': '"', "'": "'", '\\': '\\' }
+
+# Subjects are IRIs or blank nodes ("_:label"), and objects are IRIs, blank nodes, or literals
+# as (value, language, datatype) tuples
+class Literal(tuple):
+	def __new__(cls,value,language=None,datatype=None):
+		return tuple.__new__(cls,(value,language,datatype))
+
+def isBlank(node):
+	return isinstance(node,str) and node.startswith('_:')
+
+def unescape(match):
+	escape = match.group(1)
+	if escape[0] in 'uU':
+		return chr(int(escape[1:],16))
+	return ESCAPES.get(escape,escape)
+
+def parseTerm(term):
+	if term.startswith('<'):
+		return term[1:-1]
+	if term.startswith('_:'):
+		return term
+	value, language, datatype = LITERAL.match(term).groups()
+	return Literal(ESCAPE.sub(unescape,value),language,datatype)
+
+def parseNTriples(dump):
+	logger = logging.getLogger('catalog_logger')
+	for line_number, line in enumerate(dump,1):
+		line = line.decode('utf-8') if isinstance(line,bytes) else line
+		if line.strip() == '' or line.lstrip().startswith('#'):
+			continue
+
+		triple = NTRIPLE.match(line)
+		if triple is None:
+			logger.warning(f"Skipping unreadable line {line_number}: {line.strip()}")
+			continue
+
+		subject, predicate, node = triple.groups()
+		yield parseTerm(subject), predicate, parseTerm(node)
+
+# The kind of record a URI identifies, or None for anything that isn't a record on its own
+def getRecordKind(uri):
+	if isBlank(uri) or '#' in uri:
+		return None
+	for path, kind in [('/resources/works/','works'),('/resources/hubs/','hubs'),('/authorities/names/','names'),('/rwo/agents/','agents')]:
+		if path in uri:
+			return kind
+	return None
+
+# N-Triples dumps list all the triples for a record, and for the nodes nested in it, before
+# moving on to the next record, so a new group is started whenever a different Work, Hub or
+# Name appears as a subject. Blank node labels are only unique within a group.
+def groupNTriples(triples):
+	group = []
+	group_record = None
+	for subject, predicate, node in triples:
+		if getRecordKind(subject) in ['works','hubs','names'] and subject != group_record:
+			if len(group) > 0:
+				yield group
+			group = []
+			group_record = subject
+		group.append((subject,predicate,node))
+
+	if len(group) > 0:
+		yield group
+
+def getIri(tag):
+	if not tag.startswith('{'):
+		return None
+	namespace, local_name = tag[1:].split('}',1)
+	return f"{namespace}{local_name}"
+
+# Turn a node element from an RDF/XML dump, and everything nested in it, into triples
+class RDFXMLReader:
+	def __init__(self):
+		self.blank_nodes = 0
+
+	def newBlank(self):
+		self.blank_nodes += 1
+		return f"_:n{self.blank_nodes}"
+
+	def getSubject(self,element):
+		if element.get(f"{{{Namespaces.RDF}}}about") is not None:
+			return element.get(f"{{{Namespaces.RDF}}}about")
+		if element.get(f"{{{Namespaces.RDF}}}nodeID") is not None:
+			return f"_:{element.get(f'{{{Namespaces.RDF}}}nodeID')}"
+		return self.newBlank()
+
+	def readNode(self,element,triples):
+		subject = self.getSubject(element)
+		if element.tag != f"{{{Namespaces.RDF}}}Description":
+			triples.append((subject,RDF_TYPE,getIri(element.tag)))
+		self.readProperties(subject,element,triples)
+		return subject
+
+	def readProperties(self,subject,element,triples):
+		for attribute, value in element.attrib.items():
+			if attribute.startswith(f"{{{Namespaces.RDF}}}") or attribute.startswith('{http://www.w3.org/XML/1998/namespace}'):
+				if attribute == f"{{{Namespaces.RDF}}}type":
+					triples.append((subject,RDF_TYPE,value))
+				continue
+			if getIri(attribute):
+				triples.append((subject,getIri(attribute),Literal(value)))
+
+		for prop in element:
+			if not isinstance(prop.tag,str):
+				continue
+			predicate = getIri(prop.tag)
+			if predicate is None:
+				continue
+			parse_type = prop.get(f"{{{Namespaces.RDF}}}parseType")
+
+			if prop.get(f"{{{Namespaces.RDF}}}resource") is not None:
+				triples.append((subject,predicate,prop.get(f"{{{Namespaces.RDF}}}resource")))
+			elif prop.get(f"{{{Namespaces.RDF}}}nodeID") is not None:
+				triples.append((subject,predicate,f"_:{prop.get(f'{{{Namespaces.RDF}}}nodeID')}"))
+			elif parse_type == 'Resource':
+				node = self.newBlank()
+				triples.append((subject,predicate,node))
+				self.readProperties(node,prop,triples)
+			elif parse_type == 'Collection':
+				items = [self.readNode(child,triples) for child in prop if isinstance(child.tag,str)]
+				node = RDF_NIL
+				for item in reversed(items):
+					cell = self.newBlank()
+					triples.append((cell,RDF_FIRST,item))
+					triples.append((cell,RDF_REST,node))
+					node = cell
+				triples.append((subject,predicate,node))
+			elif len(prop) > 0 and parse_type != 'Literal':
+				triples.append((subject,predicate,self.readNode(prop[0],triples)))
+			else:
+				triples.append((subject,predicate,Literal("".join(prop.itertext()),prop.get('{http://www.w3.org/XML/1998/namespace}lang'),prop.get(f"{{{Namespaces.RDF}}}datatype"))))
+
+	# Each node element directly under rdf:RDF is one group
+	def groupRDFXML(self,dump):
+		depth = 0
+		for event, element in etree.iterparse(dump,events=('start','end'),remove_comments=True,huge_tree=True):
+			if event == 'start':
+				depth += 1
+				continue
+
+			depth -= 1
+			if depth == 1:
+				triples = []
+				self.readNode(element,triples)
+				element.clear()
+				while element.getprevious() is not None:
+					del element.getparent()[0]
+				yield triples
+
+def getQualifiedName(iri):
+	split = max(iri.rfind('#'),iri.rfind('/'))
+	namespace, local_name = iri[:split+1], iri[split+1:]
+	if split < 0 or not XML_NAME.match(local_name):
+		return None
+	return f"{{{namespace}}}{local_name}"
+
+def getLocalName(iri):
+	return re.split(r'[#/]',iri)[-1]
+
+# Writes Works, Hubs, Names and the labels of the agents they identify into the index read by
+# LocalCatalog in reconcileWorks.py
+class CatalogLoader:
+	def __init__(self,path):
+		self.connection = sqlite3.connect(path)
+		self.connection.execute("PRAGMA synchronous = OFF")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS records (uri TEXT PRIMARY KEY, kind TEXT NOT NULL, types TEXT NOT NULL, heading TEXT, document BLOB NOT NULL)")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS terms (kind TEXT NOT NULL, term TEXT NOT NULL, uri TEXT NOT NULL, PRIMARY KEY (kind, term, uri)) WITHOUT ROWID")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS terms_by_record ON terms (kind, uri)")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS term_counts (kind TEXT NOT NULL, term TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (kind, term)) WITHOUT ROWID")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS agents (uri TEXT PRIMARY KEY, label TEXT NOT NULL)")
+		self.stats = { 'works': 0, 'hubs': 0, 'names': 0, 'agents': 0 }
+		self.pending = 0
+
+	def getValues(self,subjects,subject,predicate):
+		return [node for p, node in subjects.get(subject,[]) if p == predicate]
+
+	def getText(self,subjects,subject,predicate):
+		values = [node[0] for node in self.getValues(subjects,subject,predicate) if isinstance(node,Literal)]
+		return values[0] if len(values) > 0 else None
+
+	def getNodeTag(self,subjects,subject):
+		types = self.getValues(subjects,subject,RDF_TYPE)
+		for node_class in NODE_CLASSES:
+			if node_class in types:
+				return getQualifiedName(node_class)
+		for node_type in types:
+			if getQualifiedName(node_type):
+				return getQualifiedName(node_type)
+		return f"{{{Namespaces.RDF}}}Description"
+
+	# Blank nodes, and nodes identified by a fragment of the record's URI, are written out
+	# nested in the property that points at them; anything else is linked with rdf:resource
+	def addProperties(self,element,record_uri,subject,subjects,path):
+		for predicate, node in subjects.get(subject,[]):
+			if predicate == RDF_TYPE and getQualifiedName(node) == element.tag:
+				continue
+			tag = getQualifiedName(predicate)
+			if tag is None:
+				continue
+
+			prop = etree.SubElement(element,tag)
+			if isinstance(node,Literal):
+				value, language, datatype = node
+				prop.text = value
+				if language:
+					prop.set('{http://www.w3.org/XML/1998/namespace}lang',language)
+				if datatype:
+					prop.set(f"{{{Namespaces.RDF}}}datatype",datatype)
+			elif (isBlank(node) or node.startswith(f"{record_uri}#")) and node in subjects and node not in path:
+				child = etree.SubElement(prop,self.getNodeTag(subjects,node))
+				if not isBlank(node):
+					child.set(f"{{{Namespaces.RDF}}}about",node)
+				self.addProperties(child,record_uri,node,subjects,path | {node})
+			elif isBlank(node):
+				prop.set(f"{{{Namespaces.RDF}}}nodeID",node[2:])
+			else:
+				prop.set(f"{{{Namespaces.RDF}}}resource",node)
+
+	# The record is written the way id.loc.gov serves it as .bibframe.rdf, with Hubs as a
+	# bf:Work typed as a bf:Hub, so it can be read with the same XPaths as online records
+	def buildDocument(self,uri,subjects):
+		root = etree.Element(f"{{{Namespaces.RDF}}}RDF",nsmap={ 'rdf': Namespaces.RDF, 'rdfs': Namespaces.RDFS, 'bf': Namespaces.BF, 'bflc': Namespaces.BFLC, 'madsrdf': Namespaces.MADSRDF })
+		work = etree.SubElement(root,f"{{{Namespaces.BF}}}Work")
+		work.set(f"{{{Namespaces.RDF}}}about",uri)
+		self.addProperties(work,uri,uri,subjects,{uri})
+		return root
+
+	def addTerms(self,kind,uri,texts):
+		terms = set()
+		for text in texts:
+			terms.update(getIndexTerms(text))
+		self.connection.executemany("INSERT OR IGNORE INTO terms (kind, term, uri) VALUES (?, ?, ?)",[(kind,term,uri) for term in terms])
+
+	def addRecord(self,kind,uri,types,heading,document,texts):
+		# A record that is loaded again is only found by the terms of its new version
+		previous = self.connection.execute("SELECT kind FROM records WHERE uri = ?",(uri,)).fetchone()
+		if previous:
+			self.connection.execute("DELETE FROM terms WHERE kind = ? AND uri = ?",(previous[0],uri))
+		self.connection.execute("INSERT OR REPLACE INTO records (uri, kind, types, heading, document) VALUES (?, ?, ?, ?, ?)",(uri,kind," ".join(types),heading,zlib.compress(document)))
+		self.addTerms(kind,uri,[heading] + texts if heading else texts)
+		self.stats[kind] += 1
+		self.pending += 1
+		if self.pending >= 10000:
+			self.connection.commit()
+			self.pending = 0
+
+	def addWork(self,kind,uri,subjects):
+		document = self.buildDocument(uri,subjects)
+		titles = XPaths.RECORD_TITLE(document) + XPaths.RECORD_VARIANT_TITLES(document)
+		heading = self.getText(subjects,uri,f"{Namespaces.BFLC}aap") or self.getText(subjects,uri,f"{Namespaces.RDFS}label")
+		if heading is None and len(titles) > 0:
+			heading = titles[0]
+		types = [getLocalName(node) for node in self.getValues(subjects,uri,RDF_TYPE)]
+		if 'Work' not in types:
+			types.append('Work')
+		self.addRecord(kind,uri,types,heading,etree.tostring(document,encoding='UTF-8',xml_declaration=True),titles)
+
+	# The name from subfield $a of a MARC heading is the FullNameElement (or NameElement for
+	# corporate names) at the start of the MADS element list, falling back on the whole label
+	def getName(self,subjects,subject,label_predicate):
+		element_list = self.getValues(subjects,subject,f"{Namespaces.MADSRDF}elementList")
+		cell = element_list[0] if len(element_list) > 0 else RDF_NIL
+		while cell != RDF_NIL and cell in subjects:
+			items = self.getValues(subjects,cell,RDF_FIRST)
+			if len(items) > 0 and any(name_element in self.getValues(subjects,items[0],RDF_TYPE) for name_element in NAME_ELEMENTS):
+				value = self.getText(subjects,items[0],f"{Namespaces.MADSRDF}elementValue")
+				if value:
+					return value
+			rest = self.getValues(subjects,cell,RDF_REST)
+			cell = rest[0] if len(rest) > 0 else RDF_NIL
+		return self.getText(subjects,subject,label_predicate)
+
+	def addName(self,uri,subjects):
+		heading = self.getText(subjects,uri,f"{Namespaces.MADSRDF}authoritativeLabel")
+		names = [self.getName(subjects,uri,f"{Namespaces.MADSRDF}authoritativeLabel")]
+		for variant in self.getValues(subjects,uri,f"{Namespaces.MADSRDF}hasVariant"):
+			names.append(self.getName(subjects,variant,f"{Namespaces.MADSRDF}variantLabel"))
+		names = [name for name in names if name]
+		labels = [self.getText(subjects,variant,f"{Namespaces.MADSRDF}variantLabel") for variant in self.getValues(subjects,uri,f"{Namespaces.MADSRDF}hasVariant")]
+
+		types = [getLocalName(node) for node in self.getValues(subjects,uri,RDF_TYPE)]
+		self.addRecord('names',uri,types,heading,json.dumps(names).encode('utf-8'),names + [label for label in labels if label])
+
+		# The real world object's own label is used if the dump describes it, otherwise its
+		# label is taken to be the authoritative label, as it is on id.loc.gov
+		if heading:
+			self.connection.execute("INSERT OR IGNORE INTO agents (uri, label) VALUES (?, ?)",(uri.replace('/authorities/names/','/rwo/agents/'),heading))
+
+	def addAgent(self,uri,subjects):
+		label = self.getText(subjects,uri,f"{Namespaces.RDFS}label") or self.getText(subjects,uri,f"{Namespaces.MADSRDF}authoritativeLabel")
+		if label:
+			self.connection.execute("INSERT OR REPLACE INTO agents (uri, label) VALUES (?, ?)",(uri,label))
+			self.stats['agents'] += 1
+
+	def addGroup(self,triples):
+		subjects = collections.defaultdict(list)
+		for subject, predicate, node in triples:
+			subjects[subject].append((predicate,node))
+
+		for subject in subjects:
+			kind = getRecordKind(subject)
+			if kind in ['works','hubs']:
+				self.addWork(kind,subject,subjects)
+			elif kind == 'names':
+				self.addName(subject,subjects)
+			elif kind == 'agents':
+				self.addAgent(subject,subjects)
+
+	# Candidates are retrieved using the rarest terms of a search, so the number of records
+	# each term appears in is counted once everything has been loaded
+	def finish(self):
+		self.connection.execute("DELETE FROM term_counts")
+		self.connection.execute("INSERT INTO term_counts (kind, term, count) SELECT kind, term, COUNT(*) FROM terms GROUP BY kind, term")
+		self.connection.commit()
+		self.connection.execute("ANALYZE")
+		self.connection.close()
+
+def openDump(path):
+	if path.endswith('.gz'):
+		return gzip.open(path,'rb')
+	return open(path,'rb')
+
+def getDumpFormat(path):
+	name = path[:-3] if path.endswith('.gz') else path
+	if name.endswith('.nt'):
+		return 'nt'
+	if name.endswith('.rdf') or name.endswith('.xml'):
+		return 'rdfxml'
+	raise Exception(f"Can't tell the format of {path}, set it with --format")
+
+# Load bulk downloads of BIBFRAME Works and Hubs and of LCNAF names from id.loc.gov into a
+# local index that reconcileWorks.py can search with "--catalog local"
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument("index", help="SQLite file to create or add to")
+	parser.add_argument("dumps", nargs='+', help="N-Triples or RDF/XML files from id.loc.gov, optionally gzipped")
+	parser.add_argument("-f", "--format", choices=['nt','rdfxml'], help="Format of the dumps, by default this is taken from the file extension")
+	parser.add_argument("-v", "--verbose", action="store_true")
+	args = parser.parse_args()
+
+	logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s',level=logging.DEBUG if args.verbose else logging.INFO)
+	logger = logging.getLogger('catalog_logger')
+
+	start_time = datetime.datetime.now()
+	loader = CatalogLoader(args.index)
+	for dump_path in args.dumps:
+		dump_format = args.format or getDumpFormat(dump_path)
+		logger.info(f"Loading {dump_path} as {dump_format}")
+		with openDump(dump_path) as dump:
+			if dump_format == 'nt':
+				groups = groupNTriples(parseNTriples(dump))
+			else:
+				groups = RDFXMLReader().groupRDFXML(dump)
+
+			for group in groups:
+				loader.addGroup(group)
+		logger.info(f"Loaded so far: {loader.stats}")
+
+	logger.info("Counting terms")
+	loader.finish()
+	logger.info(f"Finished in {datetime.datetime.now()-start_time}")
@@ -1,15 +1,22 @@
-import argparse, sys, os, logging, logging.config, requests, csv, urllib.parse, copy, json, configparser, time, datetime, redis, traceback
+import argparse, sys, os, logging, logging.config, requests, csv, urllib.parse, copy, json, configparser, time, datetime, redis, traceback, math, threading, collections, concurrent.futures, zlib, email.utils, sqlite3, functools, contextlib, gzip, io
 from lxml import etree
 from enum import Enum
 from redis.commands.json.path import Path
-from limits import RateLimitItemPerMinute
-from limits.storage import MemoryStorage
-from limits.strategies import FixedWindowRateLimiter
+from limits import parse as parseRateLimit
+from limits.storage import MemoryStorage, RedisStorage
+from limits.strategies import MovingWindowRateLimiter
 from datetime import timedelta
 
 class BrokenResponse:
 	status_code = '400'
 
+# Stands in for a requests response when the body is served from a cache
+class CachedResponse:
+	def __init__(self,content,content_type,status_code=200):
+		self.content = content
+		self.headers = { 'content-type': content_type }
+		self.status_code = status_code
+
 class Sources(Enum):
 	loc = "loc"
 	wikidata = "wikidata"
@@ -17,6 +24,13 @@ class Sources(Enum):
 	def __str__(self):
 		return self.value
 
+class Catalogs(Enum):
+	loc = "loc"
+	local = "local"
+
+	def __str__(self):
+		return self.value
+
 class Namespaces(str, Enum):
 	BF = "http://id.loc.gov/ontologies/bibframe/"
 	RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
@@ -38,37 +52,303 @@ class Mime(str, Enum):
 	def __str__(self):
 		return self.value
 
+# Every XPath used while reconciling, compiled once with the project's namespace prefixes bound
+XPATH_NAMESPACES = { "bf": Namespaces.BF, "bflc": Namespaces.BFLC, "rdf": Namespaces.RDF, "rdfs": Namespaces.RDFS, "madsrdf": Namespaces.MADSRDF, "marcxml": Namespaces.MARCXML }
+
+class XPaths:
+	# Local records
+	WORKS = etree.XPath("/rdf:RDF/bf:Work", namespaces=XPATH_NAMESPACES)
+	WORK_ID = etree.XPath("./@rdf:about", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	WORK_TITLE_PARTS = etree.XPath("./bf:title/bf:Title/bf:*/text()", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	TYPES = etree.XPath("./rdf:type/@rdf:resource", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	UNIFORM_TITLE = etree.XPath("./bf:expressionOf/bf:Hub/bf:title/bf:Title/bf:mainTitle/text()", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	VARIANT_TITLES = etree.XPath("./bf:title/bf:VariantTitle", namespaces=XPATH_NAMESPACES)
+	TITLE_PARTS = etree.XPath("./bf:*/text()", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	CONTRIBUTIONS = etree.XPath("./bf:contribution/bf:Contribution", namespaces=XPATH_NAMESPACES)
+	NOTES = etree.XPath("./bf:note/bf:Note", namespaces=XPATH_NAMESPACES)
+	NOTE_PARTS = etree.XPath("./child::*", namespaces=XPATH_NAMESPACES)
+	LANGUAGES = etree.XPath("./bf:language/@rdf:resource", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	INSTANCE_LINKS = etree.XPath("./bf:instanceOf[@rdf:resource]", namespaces=XPATH_NAMESPACES)
+	AGENT = etree.XPath("./bf:agent/bf:Agent", namespaces=XPATH_NAMESPACES)
+	AGENT_ID = etree.XPath("./bf:agent/bf:Agent/@rdf:about", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	AGENT_TYPE = etree.XPath("./bf:agent/bf:Agent/rdf:type/@rdf:resource", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	AGENT_LABEL = etree.XPath("./bf:agent/bf:Agent/rdfs:label/text()", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	AGENT_MARC_KEY = etree.XPath("./bf:agent/bf:Agent/bflc:marcKey/text()", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	AGENT_LINK = etree.XPath("./bf:agent/@rdf:resource", namespaces=XPATH_NAMESPACES, smart_strings=False)
+
+	# Rows of an id.loc.gov search results page
+	SEARCH_RESULTS = etree.XPath("//table[@class='id-std']/tbody/tr", namespaces=XPATH_NAMESPACES)
+	RESULT_HEADING = etree.XPath("./td/a/text()", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	RESULT_LINK = etree.XPath("./td/a/@href", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	RESULT_VARIANTS = etree.XPath("./td[@colspan='5']/text()", namespaces=XPATH_NAMESPACES, smart_strings=False)
+
+	# BIBFRAME records from id.loc.gov
+	RECORD_TITLE = etree.XPath("/rdf:RDF/bf:Work/bf:title/bf:Title/bf:mainTitle/text()", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	RECORD_VARIANT_TITLES = etree.XPath("/rdf:RDF/bf:Work/bf:title/bf:VariantTitle/bf:mainTitle/text()", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	RECORD_LANGUAGES = etree.XPath("/rdf:RDF/bf:Work/bf:language/@rdf:resource", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	RECORD_CONTRIBUTIONS = etree.XPath("/rdf:RDF/bf:Work/bf:contribution/bf:Contribution", namespaces=XPATH_NAMESPACES)
+	RECORD_NOTES = etree.XPath("/rdf:RDF/bf:Work/bf:note/bf:Note", namespaces=XPATH_NAMESPACES)
+	RECORD_HAS_EXPRESSION = etree.XPath("/rdf:RDF/bf:Work/bf:hasExpression/@rdf:resource", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	RECORD_EXPRESSION_OF = etree.XPath("/rdf:RDF/bf:Work/bf:expressionOf/@rdf:resource", namespaces=XPATH_NAMESPACES, smart_strings=False)
+
+	# MADS and MARC authority records from id.loc.gov
+	RWO_LABEL = etree.XPath("/rdf:RDF/madsrdf:RWO/rdfs:label/text()", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	PERSONAL_NAMES = etree.XPath("/marcxml:record/marcxml:datafield[@tag='100' or @tag='400']/marcxml:subfield[@code='a']/text()", namespaces=XPATH_NAMESPACES, smart_strings=False)
+	CORPORATE_NAMES = etree.XPath("/marcxml:record/marcxml:datafield[@tag='110' or @tag='410']/marcxml:subfield[@code='a']/text()", namespaces=XPATH_NAMESPACES, smart_strings=False)
+
 if os.name == 'nt':
 	SLASH = '\\'
 else:
 	SLASH = '/'
 
-storage = MemoryStorage()
-limiter = FixedWindowRateLimiter(storage)
-loc_limit = RateLimitItemPerMinute(200)
-
-def calculateLevenshteinDistance(string1,string2):
-	matrix = []
-	for counter1 in range(0,len(string1)+1):
-		empty_row = []
-		for counter2 in range(0,len(string2)+1):
-			empty_row.append(0)
-		matrix.append(empty_row)
-	
-	for i in range(1,len(string1)+1):
-		matrix[i][0] = i
-
-	for j in range(1,len(string2)+1):
-		matrix[0][j] = j
-
-	for j in range(1,len(string2)+1):
-		for i in range(1,len(string1)+1):
-			if string1[i-1] == string2[j-1]:
-				matrix[i][j] = matrix[i-1][j-1]
-			else:
-				matrix[i][j] = min(matrix[i-1][j]+1, matrix[i][j-1]+1,matrix[i-1][j-1]+1)
+response_cache = None
+
+# Time spent in each stage of a run and counts of the events in it, kept for the whole run
+# and written out by MetricsReport. Timings are kept by name and labels (such as the host a
+# request went to) as the number of calls, their total seconds and the longest single call.
+# Counters are kept the same way. Both are updated from every worker thread, so each thread
+# keeps its own timings and counters and they are added up when read, the same way as the
+# distance counts below. An entry is replaced rather than changed in place, so a copy taken
+# from another thread never holds a timing that is half updated.
+class RunMetrics:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.local = threading.local()
+		self.thread_metrics = []
+
+	@staticmethod
+	def getKey(name,labels):
+		return (name, tuple(sorted(labels.items())))
+
+	def getThreadMetrics(self):
+		try:
+			return self.local.metrics
+		except AttributeError:
+			metrics = self.local.metrics = ({}, {})
+			with self.lock:
+				self.thread_metrics.append(metrics)
+			return metrics
+
+	def observe(self,name,seconds,**labels):
+		self.observeKey(self.getKey(name,labels),seconds)
+
+	def observeKey(self,key,seconds):
+		timings = self.getThreadMetrics()[0]
+		timing = timings.get(key)
+		if timing is None:
+			timings[key] = (1, seconds, seconds)
+		else:
+			timings[key] = (timing[0] + 1, timing[1] + seconds, max(timing[2],seconds))
 
-	return matrix[len(string1)][len(string2)]
+	def count(self,name,value=1,**labels):
+		key = self.getKey(name,labels)
+		counters = self.getThreadMetrics()[1]
+		counters[key] = counters.get(key,0) + value
+
+	@contextlib.contextmanager
+	def timer(self,name,**labels):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name,time.perf_counter() - start,**labels)
+
+	# The timings and counters of every thread added together
+	def merge(self):
+		with self.lock:
+			thread_metrics = [(dict(timings), dict(counters)) for timings, counters in self.thread_metrics]
+
+		timings = {}
+		counters = {}
+		for thread_timings, thread_counters in thread_metrics:
+			for key, (calls, seconds, max_seconds) in thread_timings.items():
+				timing = timings.get(key)
+				timings[key] = (calls, seconds, max_seconds) if timing is None else (timing[0] + calls, timing[1] + seconds, max(timing[2],max_seconds))
+			for key, value in thread_counters.items():
+				counters[key] = counters.get(key,0) + value
+		return timings, counters
+
+	# Copies of the timings and counters, grouped by name, that are safe to read while the run goes on
+	def snapshot(self):
+		timings, counters = self.merge()
+
+		snapshot = { 'timings': {}, 'counters': {} }
+		for (name, labels), (calls, seconds, max_seconds) in sorted(timings.items()):
+			snapshot['timings'].setdefault(name,[]).append(dict(labels,calls=calls,seconds=seconds,max_seconds=max_seconds))
+		for (name, labels), value in sorted(counters.items()):
+			snapshot['counters'].setdefault(name,[]).append(dict(labels,value=value))
+		return snapshot
+
+	# Total seconds for each timing, across all of its labels
+	def getTotals(self):
+		totals = {}
+		for (name, labels), timing in self.merge()[0].items():
+			totals[name] = totals.get(name,0) + timing[1]
+		return totals
+
+run_metrics = RunMetrics()
+
+# Records every call of the decorated function under a timing, looked up when it is called so
+# that it goes to the metrics of the current run. The key for the name and labels is built
+# once, since some of the decorated functions run for every candidate.
+def timed(name,**labels):
+	key = RunMetrics.getKey(name,labels)
+	def decorate(function):
+		@functools.wraps(function)
+		def timedFunction(*args,**kwargs):
+			start = time.perf_counter()
+			try:
+				return function(*args,**kwargs)
+			finally:
+				run_metrics.observeKey(key,time.perf_counter() - start)
+		return timedFunction
+	return decorate
+
+# Callers only act on distances that fall strictly below some threshold (10% of a note's
+# length, half of a contributor name, etc.), so this converts a threshold into the largest
+# whole distance that would still be accepted, for use as the max_distance below.
+def getMaximumDistance(threshold):
+	return math.ceil(threshold) - 1
+
+# Before a distance with a limit is computed, cheap lower bounds on it are checked, and the
+# pair is ruled out without running the calculation if any of them is already over the
+# limit. Each bound holds for every pair of strings, so this never changes a result:
+#   - the difference in length, since each insertion or deletion changes it by one
+#   - the difference in character counts, since each edit adds at most one character the
+#     other string is short of, and removes at most one it has too many of
+#   - the number of shared bigrams, since each edit can break at most two of them (the
+#     q-gram lemma: at least max(|a|,|b|) - q + 1 - k * q are shared within k edits)
+# The counts for each string are kept for reuse, since the same local title, name or note is
+# compared against many candidates. How many pairs are ruled out by each bound, and how many
+# are computed, is tallied for the run. Each thread keeps its own tally so that distances on
+# different workers never wait on each other, and the tallies are added up when reported.
+QGRAM = 2
+DISTANCE_OUTCOMES = ['equal','pruned_length','pruned_characters','pruned_qgrams','computed']
+distance_counts = threading.local()
+distance_thread_stats = []
+distance_lock = threading.Lock()
+
+def countDistance(stat):
+	try:
+		stats = distance_counts.stats
+	except AttributeError:
+		stats = distance_counts.stats = dict.fromkeys(DISTANCE_OUTCOMES,0)
+		with distance_lock:
+			distance_thread_stats.append(stats)
+	stats[stat] += 1
+
+def getDistanceStats():
+	with distance_lock:
+		thread_stats = list(distance_thread_stats)
+	return { outcome: sum(stats[outcome] for stats in thread_stats) for outcome in DISTANCE_OUTCOMES }
+
+def getQGrams(text):
+	return collections.Counter(text[i:i+QGRAM] for i in range(len(text) - QGRAM + 1))
+
+# Two strings within max_distance edits of each other share at least this many q-grams
+def getSharedQGramBound(length1,length2,max_distance):
+	return max(length1,length2) - QGRAM + 1 - max_distance * QGRAM
+
+@functools.lru_cache(maxsize=8192)
+def getCharacterCounts(string):
+	return collections.Counter(string)
+
+@functools.lru_cache(maxsize=8192)
+def getCachedQGrams(string):
+	return getQGrams(string)
+
+# Size of the intersection of two multisets
+def countShared(counts1,counts2):
+	if len(counts1) > len(counts2):
+		counts1, counts2 = counts2, counts1
+	shared = 0
+	for item, count in counts1.items():
+		other_count = counts2.get(item)
+		if other_count:
+			shared += count if count < other_count else other_count
+	return shared
+
+# Returns the first bound that rules out a distance of max_distance or less between the two
+# strings, where string1 is the longer one, or None if none of them do
+def getDistancePrefilter(string1,string2,max_distance):
+	length_difference = len(string1) - len(string2)
+	if max_distance < 0 or length_difference > max_distance:
+		return 'pruned_length'
+
+	# Counting is only worth it when the limit is tight enough for the counts to rule anything out
+	if max_distance * 2 >= len(string1):
+		return None
+
+	# Every character of string1 beyond the ones it shares with string2 takes an edit
+	if len(string1) - countShared(getCharacterCounts(string1),getCharacterCounts(string2)) > max_distance:
+		return 'pruned_characters'
+
+	required_qgrams = getSharedQGramBound(len(string1),len(string2),max_distance)
+	if required_qgrams > 0 and countShared(getCachedQGrams(string1),getCachedQGrams(string2)) < required_qgrams:
+		return 'pruned_qgrams'
+
+	return None
+
+# Levenshtein Distance computed with Myers' bit-parallel algorithm (in Hyyro's formulation).
+# Each column of the edit matrix is held as a pair of bit vectors, so memory is O(n) and each
+# character of the shorter string costs a handful of integer operations instead of a full row
+# of the matrix. If max_distance is given, the calculation stops as soon as the distance is
+# known to exceed it and max_distance + 1 is returned instead of the exact distance.
+def calculateLevenshteinDistance(string1,string2,max_distance=None):
+	if string1 == string2:
+		countDistance('equal')
+		return 0
+
+	# Iterate over the shorter string and keep the longer one as the bit vector pattern
+	if len(string1) < len(string2):
+		string1, string2 = string2, string1
+	pattern_length = len(string1)
+	text_length = len(string2)
+
+	if max_distance is not None:
+		pruned_by = getDistancePrefilter(string1,string2,max_distance)
+		if pruned_by:
+			countDistance(pruned_by)
+			return max_distance + 1
+	countDistance('computed')
+	if text_length == 0:
+		return pattern_length
+
+	pattern_masks = {}
+	for i, character in enumerate(string1):
+		pattern_masks[character] = pattern_masks.get(character,0) | (1 << i)
+
+	all_bits = (1 << pattern_length) - 1
+	last_bit = 1 << (pattern_length - 1)
+	positive_vertical = all_bits
+	negative_vertical = 0
+	distance = pattern_length
+
+	for j, character in enumerate(string2):
+		matches = pattern_masks.get(character,0)
+		vertical_changes = matches | negative_vertical
+		horizontal_changes = ((((matches & positive_vertical) + positive_vertical) & all_bits) ^ positive_vertical) | matches
+		positive_horizontal = negative_vertical | (~(horizontal_changes | positive_vertical) & all_bits)
+		negative_horizontal = positive_vertical & horizontal_changes
+
+		if positive_horizontal & last_bit:
+			distance += 1
+		elif negative_horizontal & last_bit:
+			distance -= 1
+
+		# The distance can drop by at most one for each remaining character
+		if max_distance is not None and distance - (text_length - j - 1) > max_distance:
+			return max_distance + 1
+
+		positive_horizontal = ((positive_horizontal << 1) | 1) & all_bits
+		negative_horizontal = (negative_horizontal << 1) & all_bits
+		positive_vertical = negative_horizontal | (~(vertical_changes | positive_horizontal) & all_bits)
+		negative_vertical = positive_horizontal & vertical_changes
+
+	if max_distance is not None and distance > max_distance:
+		return max_distance + 1
+	return distance
 
 # Stripping whitespace varies based on character encoding, and LOC results aren't always consistent
 #	with their character encodings, so to create a list of strings to check against the search term,
@@ -79,22 +359,385 @@ def normalizeVariant(variant):
 	elif isinstance(variant,unicode):
 		return variant.encode('utf-8').strip()
 
+# Persistent cache of response bodies, keyed by URL and stored in Redis. Search pages and
+# detail records are shared between many local records, and between runs on overlapping
+# batches, so a copy is kept for a configurable amount of time before going back to the
+# network. Once an entry is stale it is kept around a while longer so that it can be
+# revalidated with its ETag/Last-Modified values instead of being downloaded again.
+#
+# Bodies are stored compressed. The total size of the stored bodies is capped, and the least
+# recently used entries are evicted once the cap is reached. Storing an entry, updating the
+# total size and evicting are done together by a script that Redis runs atomically, so
+# threads and processes sharing the cache can't interleave them and throw off the total.
+# Reads record when each entry was used in batches rather than with a write per lookup.
+class ResponseCache:
+	KEY_PREFIX = 'response:'
+	USAGE_KEY = 'response-cache:usage'
+	SIZES_KEY = 'response-cache:sizes'
+	TOTAL_SIZE_KEY = 'response-cache:total-size'
+	USAGE_BATCH = 64
+
+	# KEYS: the entry, the usage, sizes and total size keys
+	# ARGV: the URL, the time, the entry's expiry, the cap, the key prefix, the size of the body,
+	# then the entry's fields and values
+	# Evicting drops the least recently used entries until the total is back under the cap.
+	# Entries that already expired out of Redis are still tracked, so they're cleaned up as well.
+	# Returns the number of entries evicted.
+	STORE_SCRIPT = """
+		local url = ARGV[1]
+		local previous_size = tonumber(redis.call('HGET', KEYS[3], url) or 0)
+		for i = 7, #ARGV, 2 do
+			redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+		end
+		redis.call('EXPIRE', KEYS[1], ARGV[3])
+		redis.call('ZADD', KEYS[2], ARGV[2], url)
+		local size = tonumber(ARGV[6])
+		redis.call('HSET', KEYS[3], url, size)
+		local total_size = redis.call('INCRBY', KEYS[4], size - previous_size)
+
+		local max_size = tonumber(ARGV[4])
+		local evicted = 0
+		while total_size > max_size do
+			local oldest = redis.call('ZPOPMIN', KEYS[2], 16)
+			if #oldest == 0 then
+				break
+			end
+			for i = 1, #oldest, 2 do
+				local oldest_size = tonumber(redis.call('HGET', KEYS[3], oldest[i]) or 0)
+				redis.call('DEL', ARGV[5] .. oldest[i])
+				redis.call('HDEL', KEYS[3], oldest[i])
+				total_size = redis.call('DECRBY', KEYS[4], oldest_size)
+				evicted = evicted + 1
+			end
+		end
+		return evicted
+	"""
+
+	def __init__(self,connection,ttl,stale_ttl,max_size):
+		self.connection = connection
+		self.ttl = ttl
+		self.stale_ttl = stale_ttl
+		self.max_size = max_size
+		self.store_script = connection.register_script(self.STORE_SCRIPT)
+		self.lock = threading.Lock()
+		self.usage = {}
+		self.stats = { 'hits': 0, 'revalidated': 0, 'misses': 0, 'stored': 0, 'evicted': 0 }
+
+	def count(self,stat):
+		with self.lock:
+			self.stats[stat] += 1
+
+	# Returns the cached entry for a URL, if there is one, along with whether it is still fresh
+	def lookup(self,url):
+		entry = self.connection.hgetall(f"{self.KEY_PREFIX}{url}")
+		if not entry:
+			return None, False
+
+		self.touch(url)
+		fresh = time.time() - float(entry[b'fetched']) < self.ttl
+		return entry, fresh
+
+	# Note that an entry was used, and write the times of the last batch of entries used once
+	# it is full
+	def touch(self,url):
+		with self.lock:
+			self.usage[url] = time.time()
+			if len(self.usage) < self.USAGE_BATCH:
+				return
+			usage, self.usage = self.usage, {}
+		self.writeUsage(usage)
+
+	def flushUsage(self):
+		with self.lock:
+			usage, self.usage = self.usage, {}
+		if usage:
+			self.writeUsage(usage)
+
+	# Only entries that are still tracked are updated, so an entry evicted since it was read
+	# isn't tracked again
+	def writeUsage(self,usage):
+		self.connection.zadd(self.USAGE_KEY,usage,xx=True)
+
+	def getResponse(self,entry):
+		return CachedResponse(zlib.decompress(entry[b'body']),entry[b'content_type'].decode('utf-8'))
+
+	# Headers that allow the server to answer with a 304 if a stale entry hasn't changed
+	def getValidators(self,entry):
+		validators = {}
+		if entry and entry.get(b'etag'):
+			validators['If-None-Match'] = entry[b'etag'].decode('utf-8')
+		if entry and entry.get(b'last_modified'):
+			validators['If-Modified-Since'] = entry[b'last_modified'].decode('utf-8')
+		return validators
+
+	# Mark a stale entry as fresh again after the server confirmed it hasn't changed
+	def refresh(self,url):
+		key = f"{self.KEY_PREFIX}{url}"
+		pipeline = self.connection.pipeline()
+		pipeline.hset(key,'fetched',time.time())
+		pipeline.expire(key,self.ttl + self.stale_ttl)
+		pipeline.execute()
+
+	def store(self,url,response):
+		body = zlib.compress(response.content)
+		entry = {
+			'body': body,
+			'content_type': response.headers.get('content-type',''),
+			'etag': response.headers.get('ETag',''),
+			'last_modified': response.headers.get('Last-Modified',''),
+			'fetched': time.time()
+		}
+		keys = [f"{self.KEY_PREFIX}{url}", self.USAGE_KEY, self.SIZES_KEY, self.TOTAL_SIZE_KEY]
+		fields = [value for field in entry.items() for value in field]
+		evicted = self.store_script(keys=keys,args=[url, time.time(), self.ttl + self.stale_ttl, self.max_size, self.KEY_PREFIX, len(body)] + fields)
+		with self.lock:
+			self.stats['stored'] += 1
+			self.stats['evicted'] += evicted
+
+	# Revalidated entries are counted as misses since they needed a request, but no body was
+	# downloaded for them, so they count toward the hit ratio
+	def getHitRatio(self):
+		lookups = self.stats['hits'] + self.stats['misses']
+		return ((self.stats['hits'] + self.stats['revalidated']) / lookups) if lookups > 0 else 0
+
+# Limits the rate of requests to each host with a sliding window. When the window is kept in
+# Redis, the limit is shared by every thread and every process using the same database, so
+# several runs against LOC at once stay within one budget. When a server responds with a 429,
+# requests to that host are paused for everyone sharing the budget until its Retry-After has
+# passed. Time spent waiting, either on the limit or on a pause, is tallied for each host.
+class HostRateLimiter:
+	PAUSE_KEY_PREFIX = 'rate-limit-pause:'
+
+	def __init__(self,storage,host_limits,connection=None):
+		self.limiter = MovingWindowRateLimiter(storage)
+		self.host_limits = host_limits
+		self.connection = connection
+		self.local_pauses = {}
+		self.lock = threading.Lock()
+		self.stats = {}
+
+	def record(self,host,stat,value):
+		with self.lock:
+			host_stats = self.stats.setdefault(host,{ 'limit_wait': 0, 'pause_wait': 0, 'throttled': 0 })
+			host_stats[stat] += value
+
+	# Seconds left on a pause for a host, if there is one
+	def getPauseRemaining(self,host):
+		if self.connection:
+			remaining = self.connection.pttl(f"{self.PAUSE_KEY_PREFIX}{host}")
+			return remaining / 1000 if remaining > 0 else 0
+		return max(self.local_pauses.get(host,0) - time.time(),0)
+
+	def pause(self,url,seconds):
+		host = urllib.parse.urlsplit(url).hostname
+		self.record(host,'throttled',1)
+		if self.connection:
+			self.connection.set(f"{self.PAUSE_KEY_PREFIX}{host}",1,px=max(int(seconds * 1000),1))
+		else:
+			with self.lock:
+				self.local_pauses[host] = max(self.local_pauses.get(host,0),time.time() + seconds)
+
+	# Wait until a request can be made to the host of a URL
+	def acquire(self,url):
+		logger = logging.getLogger('reconciliation_logger')
+		host = urllib.parse.urlsplit(url).hostname
+
+		pause_remaining = self.getPauseRemaining(host)
+		while pause_remaining > 0:
+			logger.debug("Requests to %s paused for %s seconds",host,pause_remaining)
+			time.sleep(pause_remaining)
+			self.record(host,'pause_wait',pause_remaining)
+			pause_remaining = self.getPauseRemaining(host)
+
+		limit = self.host_limits.get(host)
+		if limit:
+			while not self.limiter.hit(limit,host):
+				logger.debug("Hit limit")
+				wait = min(max(self.limiter.get_window_stats(limit,host)[0] - time.time(),0.05),1)
+				time.sleep(wait)
+				self.record(host,'limit_wait',wait)
+
+# Retry-After is either a number of seconds or an HTTP date. Without one, wait a minute.
+def getRetryAfter(response):
+	retry_after = response.headers.get('Retry-After')
+	if retry_after:
+		try:
+			return max(float(retry_after),0)
+		except ValueError:
+			try:
+				return max((email.utils.parsedate_to_datetime(retry_after) - datetime.datetime.now(datetime.timezone.utc)).total_seconds(),0)
+			except (TypeError, ValueError):
+				pass
+	return 60
+
+DEFAULT_RATE_LIMITS = { 'id.loc.gov': '200/minute', 'www.wikidata.org': '200/minute', 'query.wikidata.org': '60/minute' }
+rate_limiter = HostRateLimiter(MemoryStorage(),{ host: parseRateLimit(limit) for host, limit in DEFAULT_RATE_LIMITS.items() })
+
+# All requests go through one shared session so that connections to each host are kept alive
+# and reused instead of paying for a new TCP and TLS handshake every time. Each host gets its
+# own pool, and requests wait for a free connection once a pool is in use, which keeps the
+# number of open connections per host bounded when reconciling Works concurrently.
+HTTP_HOSTS = ['id.loc.gov','www.wikidata.org','query.wikidata.org']
+
+# Sends the requests for a host to another base URL, such as a mirror or a stand-in server
+# for testing, while the URLs used everywhere else, including in the output, stay the same
+class HostOverrideAdapter(requests.adapters.HTTPAdapter):
+	def __init__(self,base_url,**kwargs):
+		self.base_url = base_url.rstrip('/')
+		super().__init__(**kwargs)
+
+	def send(self,request,**kwargs):
+		url = urllib.parse.urlsplit(request.url)
+		request.url = f"{self.base_url}{url.path}{'?' + url.query if url.query else ''}"
+		return super().send(request,**kwargs)
+
+def createSession(default_pool_size=10,host_pool_sizes={},host_overrides={}):
+	session = requests.Session()
+	session.headers.update({ 'User-Agent': 'reconcileWorks / 0.1 University Library, University of Illinois' })
+	session.mount('https://',requests.adapters.HTTPAdapter(pool_maxsize=default_pool_size,pool_block=True))
+	session.mount('http://',requests.adapters.HTTPAdapter(pool_maxsize=default_pool_size,pool_block=True))
+	for host in HTTP_HOSTS + [h for h in host_pool_sizes if h not in HTTP_HOSTS]:
+		pool_size = host_pool_sizes.get(host,default_pool_size)
+		session.mount(f"https://{host}/",requests.adapters.HTTPAdapter(pool_connections=1,pool_maxsize=pool_size,pool_block=True))
+	for host, base_url in host_overrides.items():
+		adapter = HostOverrideAdapter(base_url,pool_connections=1,pool_maxsize=host_pool_sizes.get(host,default_pool_size),pool_block=True)
+		session.mount(f"https://{host}/",adapter)
+		session.mount(f"http://{host}/",adapter)
+	return session
+
+# Number of requests made and connections opened for each host, taken from the session's
+# connection pools. Every request beyond the first on a connection reused it.
+def getConnectionStats(session):
+	stats = {}
+	for adapter in set(session.adapters.values()):
+		for pool_key in adapter.poolmanager.pools.keys():
+			pool = adapter.poolmanager.pools[pool_key]
+			host_stats = stats.setdefault(pool.host,{ 'requests': 0, 'connections': 0 })
+			host_stats['requests'] += pool.num_requests
+			host_stats['connections'] += pool.num_connections
+
+	for host_stats in stats.values():
+		host_stats['reused'] = host_stats['requests'] - host_stats['connections']
+	return stats
+
+http_session = createSession()
+
+# Many Works in a batch share titles, so the same search is often requested again within a
+# run, sometimes while the first request for it is still in progress on another thread. Any
+# request for a URL that is already in flight waits for that request to finish and shares
+# its response instead of making its own.
+#
+# Searches that found nothing (404s, empty result tables, and Wikidata queries without any
+# results) are also remembered for the rest of the run, up to a configurable age, so that
+# they aren't repeated. 404s are recognized here, while empty results are reported by the
+# callers once they have parsed the response, so that no body is parsed twice. These are kept
+# compressed in memory, and only the most recently used ones are kept once the limit on the
+# number of entries is reached.
+class RequestCoalescer:
+	def __init__(self,negative_ttl,max_negative_entries):
+		self.negative_ttl = negative_ttl
+		self.max_negative_entries = max_negative_entries
+		self.lock = threading.Lock()
+		self.in_flight = {}
+		self.negative_responses = collections.OrderedDict()
+		self.stats = { 'coalesced': 0, 'negative_hits': 0, 'negative_stored': 0 }
+
+	def get(self,url,response_type,fetch):
+		with self.lock:
+			negative_response = self.negative_responses.get(url)
+			if negative_response and negative_response[0] > time.time():
+				self.negative_responses.move_to_end(url)
+				self.stats['negative_hits'] += 1
+				expires, status_code, content, content_type = negative_response
+				return CachedResponse(zlib.decompress(content),content_type,status_code)
+
+			in_flight = self.in_flight.get(url)
+			already_requested = in_flight is not None
+			if already_requested:
+				self.stats['coalesced'] += 1
+			else:
+				in_flight = concurrent.futures.Future()
+				self.in_flight[url] = in_flight
+
+		if already_requested:
+			return in_flight.result()
+
+		try:
+			result = fetch(url,response_type)
+			if result.status_code == 404:
+				self.storeNegative(url,result)
+			in_flight.set_result(result)
+			return result
+		except BaseException as e:
+			in_flight.set_exception(e)
+			raise
+		finally:
+			with self.lock:
+				del self.in_flight[url]
+
+	# Called by a caller that found no results in a response it parsed. Responses that were
+	# themselves served from here are already remembered.
+	def rememberEmpty(self,url,response):
+		if response.status_code != 200:
+			return
+		with self.lock:
+			negative_response = self.negative_responses.get(url)
+			if negative_response and negative_response[0] > time.time():
+				return
+		self.storeNegative(url,response)
+
+	def storeNegative(self,url,response):
+		with self.lock:
+			self.negative_responses[url] = (time.time() + self.negative_ttl, response.status_code, zlib.compress(response.content), response.headers.get('content-type',''))
+			self.negative_responses.move_to_end(url)
+			self.stats['negative_stored'] += 1
+			while len(self.negative_responses) > self.max_negative_entries:
+				self.negative_responses.popitem(last=False)
+
+request_coalescer = RequestCoalescer(86400,10000)
+
 def getRequest(url,response_type):
+	with run_metrics.timer('request',host=urllib.parse.urlsplit(url).hostname):
+		return request_coalescer.get(url,response_type,fetchResponse)
+
+# Make a request once the rate limit allows it, timing the wait separately from the request
+def sendRequest(url,host,headers):
+	with run_metrics.timer('request_wait',host=host):
+		rate_limiter.acquire(url)
+	with run_metrics.timer('request_transfer',host=host):
+		result = http_session.get(url, headers=headers, timeout=60)
+	run_metrics.count('responses',host=host,status=str(result.status_code))
+	return result
+
+def fetchResponse(url,response_type):
 	logger = logging.getLogger('reconciliation_logger')
 	MAX_RETRIES = 10
+	host = urllib.parse.urlsplit(url).hostname
+
+	cached_entry = None
+	if response_cache:
+		cached_entry, fresh = response_cache.lookup(url)
+		if fresh:
+			response_cache.count('hits')
+			return response_cache.getResponse(cached_entry)
+
+	headers = {}
+	if response_cache:
+		response_cache.count('misses')
+		headers.update(response_cache.getValidators(cached_entry))
 
 	for attempt_number in range(MAX_RETRIES):
 		try:
-			if 'id.loc.gov' in url:
-				while not limiter.hit(loc_limit, "loc"):
-					logger.debug("Hit limit")
-					time.sleep(0.5)
-
-			result = requests.get(url, headers={ 'User-Agent': 'reconcileWorks / 0.1 University Library, University of Illinois' }, timeout=60)
+			result = sendRequest(url,host,headers)
 			if result.status_code == 429:
 				logger.debug(result.headers.get("Retry-After"))
-				time.sleep(60)
-				result = requests.get(url,timeout=60)
+				rate_limiter.pause(url,getRetryAfter(result))
+				result = sendRequest(url,host,headers)
+
+			if result.status_code == 304 and cached_entry:
+				response_cache.refresh(url)
+				response_cache.count('revalidated')
+				return response_cache.getResponse(cached_entry)
 
 			if result.status_code == 404:
 				break
@@ -106,9 +749,14 @@ def getRequest(url,response_type):
 				logger.warning(result.status_code)
 				raise TypeError('Response content-type does not match expected value')
 
+			if response_cache:
+				if result.status_code == 200:
+					response_cache.store(url,result)
+
 			break
 		except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ValueError, TypeError) as e:
 			if attempt_number < (MAX_RETRIES-1):
+				run_metrics.count('retries',host=host)
 				logger.warning(f"Request failed at attempt number {attempt_number}")
 				logger.warning(e)
 				time.sleep(2**attempt_number)
@@ -125,11 +773,246 @@ def getRequest(url,response_type):
 
 	return result
 
+# Searches and records for candidate Works, Hubs and Names. LOCCatalog asks id.loc.gov for
+# them, while LocalCatalog reads them from an index built from LOC's bulk downloads by
+# loadLocalCatalog.py. Both hand back the same BIBFRAME records, so candidates are scored the
+# same way whichever one is used.
+SEARCH_URL = 'https://id.loc.gov/search/?q='
+
+def getSearchUrl(text_string,type_names,resource):
+	RDFTYPES = "".join([f"+rdftype:{x}" for x in type_names])
+	return f"{SEARCH_URL}{urllib.parse.quote_plus(text_string)}{RDFTYPES}&q=cs:{urllib.parse.quote_plus(resource)}"
+
+class LOCCatalog:
+	# Yields the URI, authorized heading and variant headings of each search result
+	def search(self,text_string,type_names,resource):
+		logger = logging.getLogger('reconciliation_logger')
+		search_url = getSearchUrl(text_string,type_names,resource)
+		response = getRequest(search_url,Mime.HTML)
+		result_table = XPaths.SEARCH_RESULTS(etree.HTML(response.content))
+		if len(result_table) == 0:
+			request_coalescer.rememberEmpty(search_url,response)
+
+		i = 0
+		while i < len(result_table):
+			authorized_heading = XPaths.RESULT_HEADING(result_table[i])
+			logger.debug("\tAUTHORIZED HEADING: %s",authorized_heading)
+			variant_headings = XPaths.RESULT_VARIANTS(result_table[i+1])
+			logger.debug("\tVARIANT HEADINGS: %s",variant_headings)
+			if len(variant_headings) > 0:
+				variant_headings = [normalizeVariant(variant) for variant in variant_headings[0].split(';')]
+
+			if len(authorized_heading) > 0 or len(variant_headings) > 0:
+				yield 'http://id.loc.gov' + XPaths.RESULT_LINK(result_table[i])[0], authorized_heading, variant_headings
+
+			i = i + 2
+
+	def getRecord(self,found_uri):
+		logger = logging.getLogger('reconciliation_logger')
+		details = getRequest(f"{found_uri.replace('http','https')}.bibframe.rdf",Mime.BIBFRAMEXML)
+		try:
+			with run_metrics.timer('parse',record='bibframe'):
+				return etree.XML(details.content)
+		except etree.XMLSyntaxError:
+			logger.error(details.content)
+			logger.error(details.status_code)
+			raise
+
+	def getAgentLabel(self,agent_uri):
+		agent_tree = etree.XML(getRequest(f"{agent_uri}.rdf",Mime.MADSXML).content)
+		agent_label = XPaths.RWO_LABEL(agent_tree)
+		return agent_label[0] if len(agent_label) > 0 else None
+
+	# Yields the URI of each LCNAF search result along with the names in its MARC record
+	def searchNames(self,name,search_on):
+		search_url = getSearchUrl(name,[search_on],'http://id.loc.gov/authorities/names')
+		response = getRequest(search_url,Mime.HTML)
+		result_table = XPaths.SEARCH_RESULTS(etree.HTML(response.content))
+		if len(result_table) == 0:
+			request_coalescer.rememberEmpty(search_url,response)
+
+		for row in result_table[::2]:
+			found_uri = 'http://id.loc.gov' + XPaths.RESULT_LINK(row)[0]
+			details_tree = etree.XML(getRequest(f"{found_uri.replace('http','https')}.marcxml.xml",Mime.MARCXML).content)
+			if search_on == 'PersonalName':
+				yield found_uri, XPaths.PERSONAL_NAMES(details_tree)
+			else:
+				yield found_uri, XPaths.CORPORATE_NAMES(details_tree)
+
+# Lowercased words and the character trigrams of each word, which is what the local index
+# retrieves candidates by. Words are prefixed with "w:" and trigrams with "g:".
+def getIndexTerms(text):
+	words = "".join([c if c.isalnum() else ' ' for c in text.lower()]).split()
+	terms = set([f"w:{word}" for word in words])
+	for word in words:
+		padded = f" {word} "
+		terms.update([f"g:{padded[i:i+3]}" for i in range(len(padded) - 2)])
+	return terms
+
+# The index is a SQLite database, opened read-only with one connection per thread. Candidates
+# are the records sharing the most terms with the search string, counting only the rarest
+# terms so that common words and trigrams don't drag in half the catalog. The record's
+# heading stands in for the authorized heading on a search results page; there are no
+# variant headings, but the record's own variant titles are scored as they would be online.
+class LocalCatalog:
+	def __init__(self,path,candidates=25,query_terms=12):
+		if not os.path.exists(path):
+			raise Exception(f"Local catalog {path} does not exist, build it with loadLocalCatalog.py")
+		self.path = path
+		self.candidates = candidates
+		self.query_terms = query_terms
+		self.connections = threading.local()
+
+	def getConnection(self):
+		if not hasattr(self.connections,'connection'):
+			self.connections.connection = sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(self.path))}?mode=ro",uri=True)
+		return self.connections.connection
+
+	def findCandidates(self,kind,text_string,type_names):
+		connection = self.getConnection()
+		terms = list(getIndexTerms(text_string))
+		if len(terms) == 0:
+			return []
+
+		placeholders = ",".join(["?"] * len(terms))
+		term_counts = connection.execute(f"SELECT term FROM term_counts WHERE kind = ? AND term IN ({placeholders}) ORDER BY count, term LIMIT ?",[kind] + terms + [self.query_terms]).fetchall()
+		query_terms = [term for (term,) in term_counts]
+		if len(query_terms) == 0:
+			return []
+
+		placeholders = ",".join(["?"] * len(query_terms))
+		rows = connection.execute(f"SELECT records.uri, records.types, records.heading, COUNT(*) AS shared FROM terms JOIN records ON records.uri = terms.uri WHERE terms.kind = ? AND terms.term IN ({placeholders}) GROUP BY records.uri ORDER BY shared DESC, records.uri LIMIT ?",[kind] + query_terms + [self.candidates * 4]).fetchall()
+
+		candidates = []
+		for uri, types, heading, shared in rows:
+			if all(type_name in types.split() for type_name in type_names):
+				candidates.append((uri,heading))
+				if len(candidates) == self.candidates:
+					break
+		return candidates
+
+	def search(self,text_string,type_names,resource):
+		for found_uri, heading in self.findCandidates(resource.rsplit('/',1)[1],text_string,type_names):
+			yield found_uri, [heading], []
+
+	def getDocument(self,uri):
+		row = self.getConnection().execute("SELECT document FROM records WHERE uri = ?",(uri,)).fetchone()
+		if row is None:
+			raise Exception(f"{uri} is not in the local catalog")
+		return zlib.decompress(row[0])
+
+	def getRecord(self,found_uri):
+		return etree.XML(self.getDocument(found_uri))
+
+	def getAgentLabel(self,agent_uri):
+		row = self.getConnection().execute("SELECT label FROM agents WHERE uri = ?",(agent_uri,)).fetchone()
+		return row[0] if row else None
+
+	# Name records are stored as a JSON list of the names that would be in subfield $a of
+	# the MARC record's 1XX and 4XX fields
+	def searchNames(self,name,search_on):
+		for found_uri, heading in self.findCandidates('names',name,[search_on]):
+			yield found_uri, json.loads(self.getDocument(found_uri))
+
+catalog = LOCCatalog()
+
+# Fields that candidates are scored on, extracted once from each local Work and from each
+# candidate record, so that nothing has to be read from an XML tree while scoring. Titles and
+# languages are tuples of strings and notes are a tuple of the dicts made by getNotes. Local
+# contributors are (name, type) tuples and candidate contributors are (agent link, name, type)
+# tuples, with None for anything that is missing; a candidate's name is only read from the
+# record when its agent isn't linked.
+WorkFeatures = collections.namedtuple('WorkFeatures',['titles','languages','contributors','notes'])
+CandidateFeatures = collections.namedtuple('CandidateFeatures',['titles','languages','contributors','notes','has_expression','expression_of'])
+
+def getFirst(values):
+	return values[0] if len(values) > 0 else None
+
+def getWorkFeatures(titles,work):
+	contributors = tuple([(getFirst(XPaths.AGENT_LABEL(contributor)),getFirst(XPaths.TYPES(contributor))) for contributor in XPaths.CONTRIBUTIONS(work)])
+	return WorkFeatures(tuple(titles),tuple(XPaths.LANGUAGES(work)),contributors,tuple(getNotes(XPaths.NOTES(work))))
+
+def getCandidateFeatures(details_tree):
+	contributors = []
+	for record_contributor in XPaths.RECORD_CONTRIBUTIONS(details_tree):
+		agent_link = getFirst(XPaths.AGENT_LINK(record_contributor))
+		agent_label = None if agent_link else getFirst(XPaths.AGENT_LABEL(record_contributor))
+		contributors.append((agent_link,agent_label,getFirst(XPaths.TYPES(record_contributor))))
+
+	return CandidateFeatures(tuple(XPaths.RECORD_TITLE(details_tree) + XPaths.RECORD_VARIANT_TITLES(details_tree)),tuple(XPaths.RECORD_LANGUAGES(details_tree)),tuple(contributors),tuple(getNotes(XPaths.RECORD_NOTES(details_tree))),tuple(XPaths.RECORD_HAS_EXPRESSION(details_tree)),tuple(XPaths.RECORD_EXPRESSION_OF(details_tree)))
+
+# The same records turn up as candidates for many local Works, so the features taken from each
+# one are kept by URI, both in memory for the rest of the run and compressed in Redis for later
+# runs. The most recently used entries are kept in memory once the limit on the number of
+# entries is reached. Features for all the candidates of a search are read from Redis together,
+# and only the records that are in neither place are fetched and parsed.
+class CandidateFeatureCache:
+	KEY_PREFIX = 'features:'
+
+	def __init__(self,connection,namespace,ttl,max_entries):
+		self.connection = connection
+		self.key_prefix = f"{self.KEY_PREFIX}{namespace}:"
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.stats = { 'memory_hits': 0, 'redis_hits': 0, 'misses': 0 }
+
+	def encode(self,features):
+		return zlib.compress(json.dumps(features).encode('utf-8'))
+
+	def decode(self,value):
+		titles, languages, contributors, notes, has_expression, expression_of = json.loads(zlib.decompress(value))
+		return CandidateFeatures(tuple(titles),tuple(languages),tuple([tuple(contributor) for contributor in contributors]),tuple(notes),tuple(has_expression),tuple(expression_of))
+
+	def remember(self,uri,features):
+		with self.lock:
+			self.entries[uri] = features
+			self.entries.move_to_end(uri)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+	# Returns the features that are already cached for any of the URIs
+	def lookup(self,uris):
+		features_by_uri = {}
+		with self.lock:
+			for uri in uris:
+				if uri in self.entries:
+					self.entries.move_to_end(uri)
+					features_by_uri[uri] = self.entries[uri]
+			self.stats['memory_hits'] += len(features_by_uri)
+
+		missing = [uri for uri in dict.fromkeys(uris) if uri not in features_by_uri]
+		if self.connection is not None and len(missing) > 0:
+			for uri, value in zip(missing,self.connection.mget([f"{self.key_prefix}{uri}" for uri in missing])):
+				if value is not None:
+					features_by_uri[uri] = self.decode(value)
+					self.remember(uri,features_by_uri[uri])
+					with self.lock:
+						self.stats['redis_hits'] += 1
+
+		return features_by_uri
+
+	# Keep the features of records that had to be fetched
+	def store(self,features_by_uri):
+		for uri, features in features_by_uri.items():
+			self.remember(uri,features)
+		with self.lock:
+			self.stats['misses'] += len(features_by_uri)
+
+		if self.connection is not None and len(features_by_uri) > 0:
+			pipeline = self.connection.pipeline(transaction=False)
+			for uri, features in features_by_uri.items():
+				pipeline.set(f"{self.key_prefix}{uri}",self.encode(features),ex=self.ttl)
+			pipeline.execute()
+
+feature_cache = CandidateFeatureCache(None,Catalogs.loc.value,2592000,10000)
+
 # Utility for structuring notes as needed for processing
 def getNotes(notes):
 	note_list = []
 	for n in notes:
-		n_children = n.xpath('./child::*')
+		n_children = XPaths.NOTE_PARTS(n)
 
 		new_note = {}
 		for n_child in n_children:
@@ -152,27 +1035,28 @@ def getNotes(notes):
 # divided by the number of notes found. This is more generous than dividing by the 
 # number of notes in the local record because a match is seen as pretty significant
 # since they can be so unique.
+@timed('scoring',scorer='compareNotes')
 def compareNotes(local_notes,loc_notes):
 	logger = logging.getLogger('reconciliation_logger')
-	logger.debug(f"\t\tCalculating score based on note similarities")
-	logger.debug(f"\t\tLocal notes: {local_notes}")
-	logger.debug(f"\t\tLOC notes: {loc_notes}")
+	logger.debug("\t\tCalculating score based on note similarities")
+	logger.debug("\t\tLocal notes: %s",local_notes)
+	logger.debug("\t\tLOC notes: %s",loc_notes)
 	if len(local_notes) > 0:
 		found_note_count = 0
 		found_note_value = 0
 		for note in local_notes:
 			for loc_note in loc_notes:
-				logger.debug(f"\t\tLocal note: {note}")
-				logger.debug(f"\t\tLOC note: {loc_note}")
+				logger.debug("\t\tLocal note: %s",note)
+				logger.debug("\t\tLOC note: %s",loc_note)
 				score_card = 0
 				score_value = 0
 				for element in note:
 					if element in loc_note:
 						if element == '{http://www.w3.org/2000/01/rdf-schema#}label':
-							l_dist = calculateLevenshteinDistance(note[element],loc_note[element])
+							l_dist = calculateLevenshteinDistance(note[element],loc_note[element],getMaximumDistance(len(note[element]) * 0.1))
 
 							if l_dist < len(note[element]) * 0.1:
-								logger.debug(f"\t\tMax allowed distance: {len(note[element]) * 0.1}")
+								logger.debug("\t\tMax allowed distance: %s",len(note[element]) * 0.1)
 								score_card += 1
 								score_value += (len(note[element]) - l_dist)/(len(note[element]))
 						else:
@@ -192,24 +1076,89 @@ def compareNotes(local_notes,loc_notes):
 # Find the best fit of all possible title matches based on Levenshtein Distance. Use the
 # distance to generate a value between 0 and 1. Highest score is reutrned, but divided 
 # in half to lessen the weight of title matches.
+@timed('scoring',scorer='compareTitles')
 def compareTitles(target_title,candidate_titles):
 	logger = logging.getLogger('reconciliation_logger')
 	best_fit = 0
-	logger.debug(f"\t\tCalculating score based on title similarities")
+	# Only candidates closer than the best one so far can raise the score
+	best_distance = len(target_title)
+	logger.debug("\t\tCalculating score based on title similarities")
 	for candidate in candidate_titles:
-		logger.debug(f"\t\t{target_title}")
-		logger.debug(f"\t\t{candidate}")
-		l_dist = calculateLevenshteinDistance(target_title,candidate)
-		logger.debug(f"\t\tDistance: {l_dist}")
+		logger.debug("\t\t%s",target_title)
+		logger.debug("\t\t%s",candidate)
+		l_dist = calculateLevenshteinDistance(target_title,candidate,best_distance - 1)
+		logger.debug("\t\tDistance: %s",l_dist)
 		normalized_value = (len(target_title) - l_dist)/len(target_title)
 		if normalized_value > best_fit:
 			best_fit = normalized_value
-		logger.debug(f"\t\tAdjusted score: {normalized_value}")
+			best_distance = l_dist
+		logger.debug("\t\tAdjusted score: %s",normalized_value)
 	return (best_fit * 0.5)
 
-# Grab contributor names from LOC record, either taking the plain text, or following links and
-# taking the labels from those. The fact that most contributors are represented as links could
-# greatly expand runtime, so the results are stored in a Redis cache to prevent duplicate calls.
+# Labels for the agents that candidate records link to are kept in Redis. All the links for a
+# search are looked up with a single MGET, labels that aren't cached yet are fetched in
+# parallel, and the new ones are written back in one pipeline with an expiry.
+agent_label_ttl = 2592000
+agent_label_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8,thread_name_prefix='AgentLabel')
+agent_label_lock = threading.Lock()
+agent_label_stats = { 'hits': 0, 'misses': 0 }
+
+def resolveAgentLabels(agent_links,cache_connection):
+	logger = logging.getLogger('reconciliation_logger')
+	agent_links = list(dict.fromkeys(agent_links))
+	if len(agent_links) == 0:
+		return {}
+
+	agent_labels = {}
+	missing_links = []
+	for link, label in zip(agent_links,cache_connection.mget(agent_links)):
+		if label:
+			agent_labels[link] = label
+		elif 'id.loc.gov' in link:
+			missing_links.append(link)
+		else:
+			logger.debug("\t\tAgent link is not from loc: %s",link)
+	logger.debug("\t\tAgent labels cached for %s of %s links",len(agent_labels),len(agent_links))
+	with agent_label_lock:
+		agent_label_stats['hits'] += len(agent_labels)
+		agent_label_stats['misses'] += len(agent_links) - len(agent_labels)
+
+	fetched_labels = {}
+	futures = [agent_label_executor.submit(catalog.getAgentLabel,link) for link in missing_links]
+	for link, future in zip(missing_links,futures):
+		try:
+			label = future.result()
+			if label:
+				fetched_labels[link] = label
+		except Exception as e:
+			logger.error(link)
+			logger.error(e)
+			logger.error(traceback.format_exc())
+
+	if len(fetched_labels) > 0:
+		pipeline = cache_connection.pipeline(transaction=False)
+		for link, label in fetched_labels.items():
+			pipeline.set(link,label,ex=agent_label_ttl)
+		pipeline.execute()
+		agent_labels.update(fetched_labels)
+
+	return agent_labels
+
+# The highest score compareContributors can give for a set of local contributors, which is
+# reached when every one of them is found
+def getHighestContributorScore(local_contributors):
+	primary_contributor_count = len([local_type for local_agent, local_type in local_contributors if local_type is not None])
+	secondary_contributor_count = len(local_contributors) - primary_contributor_count
+	if primary_contributor_count > 0:
+		if secondary_contributor_count > 0:
+			return 3
+		return 2 if primary_contributor_count > 1 else 1
+	if secondary_contributor_count > 1:
+		return 2
+	return secondary_contributor_count
+
+# Grab contributor names from LOC record, either taking the plain text, or taking the labels
+# of the agents it links to, which have been looked up with resolveAgentLabels.
 #
 # Once the LOC candidates are collected, search for each contributor from the local record in 
 # that list. Matches are found by checking if the contributor types match, and calculating the 
@@ -224,7 +1173,8 @@ def compareTitles(target_title,candidate_titles):
 # record, which will result in some value 0-1. If more than one contributor is found, the score
 # is two times the score over the number of potential contributors, which will result in some
 # value 0-2.
-def compareContributors(local_contributors,loc_contributors,cache_connection):
+@timed('scoring',scorer='compareContributors')
+def compareContributors(local_contributors,loc_contributors,agent_labels):
 	logger = logging.getLogger('reconciliation_logger')
 	if len(local_contributors) > 0 and len(loc_contributors) > 0:
 		found_primary_contributor_count = 0
@@ -237,97 +1187,67 @@ def compareContributors(local_contributors,loc_contributors,cache_connection):
 
 		logger.debug("\t\tCalculating score based on contributor similarities")
 		loc_values = []
-		for loc_contributor in loc_contributors:
-			loc_contributor_values = {}
-			loc_type = loc_contributor.xpath("./rdf:type/@rdf:resource",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-			if len(loc_type) > 0:
-				loc_contributor_values['type'] = loc_type[0]
-
-			loc_agent_links = loc_contributor.xpath("./bf:agent/@rdf:resource",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-			logger.debug(f"\t\tLOC contributor links: {loc_agent_links}")
-			if len(loc_agent_links) > 0:
-				res = cache_connection.get(loc_agent_links[0])
-				if res:
-					loc_contributor_values['agent'] = res
-				else:
-					if 'id.loc.gov' in loc_agent_links[0]:
-						request_uri = loc_agent_links[0]
-						if request_uri.find('https') != 0:
-							request_uri.replace('http','https')
-
-						agent_tree = etree.XML(getRequest(f"{request_uri}.rdf",Mime.MADSXML).content)
-						agent_label = agent_tree.xpath("/rdf:RDF/madsrdf:RWO/rdfs:label/text()",namespaces={"rdf": Namespaces.RDF,"rdfs": Namespaces.RDFS,"madsrdf": Namespaces.MADSRDF})
-
-						if len(agent_label) > 0:
-							loc_contributor_values['agent'] = agent_label[0]
-							cache_connection.set(loc_agent_links[0],agent_label[0])
-					else:
-						logger.debug(f"\t\tAgent link is not from loc: {loc_agent_links[0]}")
-			else:
-				loc_agent_list = loc_contributor.xpath("./bf:agent/bf:Agent/rdfs:label/text()",namespaces={"bf": Namespaces.BF,"rdfs": Namespaces.RDFS})
-				if len(loc_agent_list) > 0:
-					loc_contributor_values['agent'] = loc_agent_list[0]
-
-			if len(loc_contributor_values) > 0:
-				loc_values.append(loc_contributor_values)
-		logger.debug(f"\t\tLOC contributor names: {loc_values}")
-
-		for local_contributor in local_contributors:
+		for loc_agent_link, loc_agent_label, loc_type in loc_contributors:
+			if loc_agent_link:
+				loc_agent_label = agent_labels.get(loc_agent_link)
+			if loc_agent_label is not None or loc_type is not None:
+				loc_values.append((loc_agent_label,loc_type))
+		logger.debug("\t\tLOC contributor names: %s",loc_values)
+
+		for local_agent, local_type in local_contributors:
 			best_score_count = 0
 			best_score_value = 0
 
-			local_type = local_contributor.xpath("./rdf:type/@rdf:resource",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-			local_agent = local_contributor.xpath("./bf:agent/bf:Agent/rdfs:label/text()",namespaces={"bf": Namespaces.BF,"rdfs": Namespaces.RDFS})
-			logger.debug(f"\t\tLooking for a match on local contributor {local_agent[0]}")
-			for val in loc_values:
-				logger.debug(f"\t\tChecking LOC contributor {val}")
+			logger.debug("\t\tLooking for a match on local contributor %s",local_agent)
+			for loc_agent, loc_type in loc_values:
+				logger.debug("\t\tChecking LOC contributor %s (%s)",loc_agent,loc_type)
 				score_count = 0
 				score_value = 0
 
-				logger.debug(f"\t\tscore value: {score_value}")
-				if len(local_agent) > 0:
-					if 'agent' in val:
-						logger.debug(f"\t\tLOC contributor name: {val['agent']}")
+				logger.debug("\t\tscore value: %s",score_value)
+				if local_agent is not None:
+					if loc_agent is not None:
+						logger.debug("\t\tLOC contributor name: %s",loc_agent)
 
-						l_dist = calculateLevenshteinDistance(local_agent[0],val['agent'])
-						normalized_score = (len(local_agent[0]) - l_dist) / len(local_agent[0])
+						l_dist = calculateLevenshteinDistance(local_agent,loc_agent,getMaximumDistance(len(local_agent) * 0.5))
+						normalized_score = (len(local_agent) - l_dist) / len(local_agent)
 
 						if normalized_score > 0.5:
 							score_count += 1
 							score_value += normalized_score
 
-							if len(local_type) > 0:
-								if 'type' in val and local_type[0] == val['type']:
+							if local_type is not None:
+								if loc_type is not None and local_type == loc_type:
 									score_count += 1
 									score_value += 1
 
-				logger.debug(f"\t\tscore value: {score_value}")
+				logger.debug("\t\tscore value: %s",score_value)
 				if (score_value > best_score_value or (score_count > best_score_count and score_value > 0.5)):
 					best_score_count = score_count
 					best_score_value = score_value
 
-					logger.debug(f"\t\tupdated score count: {best_score_count}")
-					logger.debug(f"\t\tupdated score value: {best_score_value}")
+					logger.debug("\t\tupdated score count: %s",best_score_count)
+					logger.debug("\t\tupdated score value: %s",best_score_value)
 
-					if len(local_agent) > 0 and 'agent' in val and l_dist == 0:
+					if local_agent is not None and loc_agent is not None and l_dist == 0:
 						break
 
-			if len(local_type) > 0:
+			if local_type is not None:
 				primary_contributor_count += 1
 				if best_score_count != 0:
 					found_primary_contributor_count += 1
 					found_primary_contributor_value += (best_score_value / best_score_count)
 
-					logger.debug(f"\t\tfound primary contributor count: {found_primary_contributor_count}")
-					logger.debug(f"\t\tfound primary contributor value: {found_primary_contributor_value}")
+					logger.debug("\t\tfound primary contributor count: %s",found_primary_contributor_count)
+					logger.debug("\t\tfound primary contributor value: %s",found_primary_contributor_value)
 			else:
 				secondary_contributor_count += 1
 				if best_score_count != 0:
 					found_contributor_count += 1
 					found_contributor_value += (best_score_value / best_score_count)
 
-					logger.debug(f"\t\tfound contributor count: {found_contributor_count}")
-					logger.debug(f"\t\tfound contributor value: {found_contributor_value}")
+					logger.debug("\t\tfound contributor count: %s",found_contributor_count)
+					logger.debug("\t\tfound contributor value: %s",found_contributor_value)
 		if found_primary_contributor_count > 0:
 			if found_primary_contributor_count > 1 or found_contributor_count > 0:
 				return (2 * (found_primary_contributor_value / primary_contributor_count) + (found_contributor_value / secondary_contributor_count))
@@ -357,7 +1277,7 @@ def findBestMatch(scores_by_title):
 	best_url = None
 	best_name = None
 	for title in scores_by_title:
-		logger.debug(f"\t\tSearching for best match on results from {title}")
+		logger.debug("\t\tSearching for best match on results from %s",title)
 		for match in scores_by_title[title]['matches']:
 			url = match
 			score = sum(scores_by_title[title]['matches'][match].values())
@@ -367,14 +1287,111 @@ def findBestMatch(scores_by_title):
 				best_score_breakdown = copy.deepcopy(scores_by_title[title]['matches'][match])
 				best_name = title
 
-			logger.debug(f"\t\tScoring {match}")
-			logger.debug(f"\t\tIndividual scores: {scores_by_title[title]['matches'][match]}")
-			logger.debug(f"\t\tFinal score: {score}")
+			logger.debug("\t\tScoring %s",match)
+			logger.debug("\t\tIndividual scores: %s",scores_by_title[title]['matches'][match])
+			logger.debug("\t\tFinal score: %s",score)
 
-	logger.debug(f"\t\tBest score from search results: {best_score}")
-	logger.debug(f"\t\tBest name from search results: {best_name}")
+	logger.debug("\t\tBest score from search results: %s",best_score)
+	logger.debug("\t\tBest name from search results: %s",best_name)
 	return (best_url, best_name, best_score_breakdown, False if best_url else True)
 
+# Highest score each field can be given, see the README for how each one is scored
+HIGHEST_FIELD_SCORES = { 'title': 0.5, 'languages': 1, 'contributors': 3, 'notes': 1, 'hub': 1 }
+
+# Detail records can be skipped for search results that look unlikely to be selected. Each
+# result's title score is estimated from the headings on the search results page, and the
+# other fields are assumed to get their highest possible scores. This is only an estimate,
+# not an upper bound: the authorized heading is often the name and title together (such as
+# "Beethoven, Ludwig van, 1770-1827. Symphonies"), while the record's own titles, which are
+# only seen once it is fetched, can score much higher. In "estimate" mode every result whose
+# estimated total clears the threshold in findBestMatch is fetched, and in "topk" mode only
+# the k of those with the highest totals, so either can skip a record that would have been
+# selected. With "off", the default, every result is fetched. "bound" is still accepted as
+# the old name of "estimate".
+class CandidatePruner:
+	MODES = ['off','estimate','topk']
+
+	def __init__(self,mode,top_k):
+		if mode == 'bound':
+			mode = 'estimate'
+		if mode not in self.MODES:
+			raise Exception(f"Candidate pruning mode must be one of {self.MODES}")
+		self.mode = mode
+		self.top_k = top_k
+		self.lock = threading.Lock()
+		self.stats = { 'fetched': 0, 'pruned': 0 }
+
+	def select(self,text_string,search_results,work_features,resource,work_uri,candidate_hubs):
+		selected = search_results
+		if self.mode != 'off':
+			field_count = 1
+			other_fields_bound = 0
+			for field in ['languages','contributors','notes']:
+				if len(getattr(work_features,field)) > 0:
+					field_count += 1
+					other_fields_bound += HIGHEST_FIELD_SCORES[field]
+
+			estimates = []
+			for position, (found_uri, authorized_heading, variant_headings) in enumerate(search_results):
+				estimate = compareTitles(text_string,set(authorized_heading + variant_headings)) + other_fields_bound
+				# A Hub that is, or could be, linked to the selected Work gets an extra field
+				if 'hubs' in resource and (work_uri or (candidate_hubs and found_uri in candidate_hubs)):
+					can_match = estimate + HIGHEST_FIELD_SCORES['hub'] > (field_count + 1) / 2.0
+				else:
+					can_match = estimate > field_count / 2.0
+				if can_match:
+					estimates.append((estimate,position))
+
+			if self.mode == 'topk':
+				estimates = sorted(estimates,key=lambda estimate: (-estimate[0],estimate[1]))[:self.top_k]
+			selected = [search_results[position] for estimate, position in sorted(estimates,key=lambda estimate: estimate[1])]
+
+		with self.lock:
+			self.stats['fetched'] += len(selected)
+			self.stats['pruned'] += len(search_results) - len(selected)
+		return selected
+
+candidate_pruner = CandidatePruner('off',5)
+
+# The searches for a Work's remaining titles are skipped once a search result scores at least
+# a set fraction of the highest total it could have been given, which by default means an
+# exact title and a full match on every other field the local record has. Such a result
+# can't be beaten by any result from the other searches.
+class EarlyExitPolicy:
+	def __init__(self,enabled,certain_ratio):
+		self.enabled = enabled
+		self.certain_ratio = certain_ratio
+		self.lock = threading.Lock()
+		self.stats = { 'stopped_early': 0, 'skipped_searches': 0 }
+
+	def getHighestScore(self,work_features,resource,work_uri,candidate_hubs):
+		highest_score = HIGHEST_FIELD_SCORES['title']
+		for field in ['languages','notes']:
+			if len(getattr(work_features,field)) > 0:
+				highest_score += HIGHEST_FIELD_SCORES[field]
+		highest_score += getHighestContributorScore(work_features.contributors)
+		if 'hubs' in resource and (work_uri or candidate_hubs):
+			highest_score += HIGHEST_FIELD_SCORES['hub']
+		return highest_score
+
+	def hasCertainMatch(self,matches,work_features,resource,work_uri,candidate_hubs):
+		if not self.enabled or len(matches) == 0:
+			return False
+
+		certain_score = self.getHighestScore(work_features,resource,work_uri,candidate_hubs) * self.certain_ratio
+		for scores in matches.values():
+			score = sum(scores.values())
+			if score > len(scores) / 2.0 and score >= certain_score - 1e-9:
+				return True
+		return False
+
+	def recordSkipped(self,skipped_titles):
+		with self.lock:
+			self.stats['stopped_early'] += 1
+			self.stats['skipped_searches'] += len(skipped_titles)
+
+early_exit = EarlyExitPolicy(True,1.0)
+
 # Search LOC based on title text, types and specify if searching for a Work or Hub.
 # If there are results, try to find matches for title, language, contributor, and
 # notes fields. Create a score for each of these fields based on how well they match.
@@ -385,100 +1402,89 @@ def findBestMatch(scores_by_title):
 # When Works are being processed, we keep track of any associated Hubs, so if a Work is 
 # selected, thos Hubs are also returned as candidates to be checked alongside the search
 # results.
-def searchForRecordLOC(placeholder_work_id,match_fields,resource,types,output_writer,cache_connection,work_uri=None,candidate_hubs=None):
+def searchForRecordLOC(placeholder_work_id,work_features,resource,types,output_writer,cache_connection,work_uri=None,candidate_hubs=None,trace=None):
 	logger = logging.getLogger('reconciliation_logger')
 	results_by_title = {}
 
-	BASE_LC_URL = 'https://id.loc.gov/search/?q='
-	RDFTYPES = "".join([f"+rdftype:{x.rsplit('/',1)[1]}" for x in types])
-	ENCODED_RESOURCE_URL = urllib.parse.quote_plus(resource)
+	type_names = [x.rsplit('/',1)[1] for x in types]
+
+	# Titles are searched one at a time, so that the rest can be skipped once a certain match
+	# has been found. The labels of the agents linked from all of a search's candidate records
+	# are looked up together, and kept for the searches on the remaining titles.
+	agent_labels = {}
+	skipped_titles = []
+	for title_position, text_string in enumerate(work_features.titles):
+		query_url = getSearchUrl(text_string,type_names,resource)
+		logger.debug("\tConducting LOC search: %s",query_url)
+
+		candidates = []
+		fetched_features = {}
+		try:
+			search_results = list(catalog.search(text_string,type_names,resource))
+			selected_results = candidate_pruner.select(text_string,search_results,work_features,resource,work_uri,candidate_hubs)
+			candidate_features = feature_cache.lookup([found_uri for found_uri, authorized_heading, variant_headings in selected_results])
+			for found_uri, authorized_heading, variant_headings in selected_results:
+				logger.debug("\tFound %s",text_string)
+				logger.debug("\t%s",found_uri)
+				if found_uri not in candidate_features:
+					candidate_features[found_uri] = fetched_features[found_uri] = getCandidateFeatures(catalog.getRecord(found_uri))
+				candidates.append((found_uri,authorized_heading,variant_headings,candidate_features[found_uri]))
+		except Exception as e:
+			logger.error(placeholder_work_id)
+			logger.error(text_string)
+			logger.error(query_url)
+			logger.error(e)
+			logger.error(traceback.format_exc())
+		feature_cache.store(fetched_features)
 
-	for text_string in match_fields['titles']:
-		ENCODED_TEXT_STRING = urllib.parse.quote_plus(text_string)
-		query_url = f"{BASE_LC_URL}{ENCODED_TEXT_STRING}{RDFTYPES}&q=cs:{ENCODED_RESOURCE_URL}"
-		logger.debug(f"\tConducting LOC search: {query_url}")
+		if len(work_features.contributors) > 0:
+			agent_links = []
+			for found_uri, authorized_heading, variant_headings, candidate in candidates:
+				agent_links += [agent_link for agent_link, agent_label, agent_type in candidate.contributors if agent_link and agent_link not in agent_labels]
+			agent_labels.update(resolveAgentLabels(agent_links,cache_connection))
 
 		match_not_found = True
-		i = 0
 		results_by_title[text_string] = {}
 		matches = {}
 		hubs = {}
 		try:
-			results_tree = etree.HTML(getRequest(query_url,Mime.HTML).content)
-			result_table = results_tree.xpath("//table[@class='id-std']/tbody/tr")
-
-			while i < len(result_table):
-				authorized_heading = result_table[i].xpath("./td/a/text()")
-				logger.debug(f"\tAUTHORIZED HEADING: {authorized_heading}")
-				variant_headings = result_table[i+1].xpath("./td[@colspan='5']/text()")
-				logger.debug(f"\tVARIANT HEADINGS: {variant_headings}")
-				if len(variant_headings) > 0:
-					variant_headings = map(normalizeVariant,variant_headings[0].split(';'))
-
-				if len(authorized_heading) > 0 or len(variant_headings) > 0:
-					logger.debug(f"\tFound {text_string}")
-					found_uri = 'http://id.loc.gov' + result_table[i].xpath("./td/a/@href")[0]
-					logger.debug(f"\t{found_uri}")
-					details = getRequest(f"{found_uri.replace('http','https')}.bibframe.rdf",Mime.BIBFRAMEXML)
-					details_content = details.content
-					details_tree = etree.XML(details_content)
-					details_title = details_tree.xpath("/rdf:RDF/bf:Work/bf:title/bf:Title/bf:mainTitle/text()",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-					logger.debug(f"\tTitle from record: {details_title}")
-					details_variant_title = details_tree.xpath("/rdf:RDF/bf:Work/bf:title/bf:VariantTitle/bf:mainTitle/text()",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-					logger.debug(f"\tVariant titles from record: {details_variant_title}")
-					found_titles = set(authorized_heading + variant_headings + details_title + details_variant_title)
-
-					logger.debug(f"\tALL SEARCH TITLES: {found_titles}")
-					matches[found_uri] = { 'title': compareTitles(text_string,found_titles) }
-
-					logger.debug(f"Searching for fields: {match_fields}")
-					if len(match_fields['languages']) > 0:
-						record_languages = details_tree.xpath("/rdf:RDF/bf:Work/bf:language/@rdf:resource",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-						language_match_count = 0
-						for lang in match_fields['languages']:
-							if lang in record_languages:
-								language_match_count += 1
-						
-						matches[found_uri]['languages'] = language_match_count / len(match_fields['languages'])
-
-					if len(match_fields['contributors']) > 0:
-						record_contributors = details_tree.xpath("/rdf:RDF/bf:Work/bf:contribution/bf:Contribution", namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-						matches[found_uri]['contributors'] = compareContributors(match_fields['contributors'],record_contributors,cache_connection)
-						logger.debug(f"\tMatches updated with contributor: {matches[found_uri]}")
-
-					if len(match_fields['notes']) > 0:
-						record_notes = details_tree.xpath("/rdf:RDF/bf:Work/bf:note/bf:Note",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-						notes_a = getNotes(match_fields['notes'])
-						notes_b = getNotes(record_notes)
-
-						matches[found_uri]['notes'] = compareNotes(notes_a,notes_b)
-						logger.debug(f"\tMatches updated with notes: {matches[found_uri]}")
-
-					if 'hubs' in resource:
-						# Check list of pre-identified hubs for the current search result, if that isn't 
-						# present, check to see if the current search result links back to the selected
-						# Work
-						if candidate_hubs and found_uri in candidate_hubs:
-							matches[found_uri]['hub'] = 1
-						else:
-							record_works = details_tree.xpath("/rdf:RDF/bf:Work/bf:hasExpression/@rdf:resource",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-							logger.debug(f"\tHub hasExpression list: {record_works}")
-							if work_uri in record_works:
-								matches[found_uri]['hub'] = 1
+			for found_uri, authorized_heading, variant_headings, candidate in candidates:
+				logger.debug("\tTitles from record: %s",candidate.titles)
+				found_titles = set(authorized_heading + variant_headings + list(candidate.titles))
+
+				logger.debug("\tALL SEARCH TITLES: %s",found_titles)
+				matches[found_uri] = { 'title': compareTitles(text_string,found_titles) }
+
+				logger.debug("Searching for fields: %s",work_features)
+				if len(work_features.languages) > 0:
+					language_match_count = 0
+					for lang in work_features.languages:
+						if lang in candidate.languages:
+							language_match_count += 1
+					
+					matches[found_uri]['languages'] = language_match_count / len(work_features.languages)
+
+				if len(work_features.contributors) > 0:
+					matches[found_uri]['contributors'] = compareContributors(work_features.contributors,candidate.contributors,agent_labels)
+					logger.debug("\tMatches updated with contributor: %s",matches[found_uri])
+
+				if len(work_features.notes) > 0:
+					matches[found_uri]['notes'] = compareNotes(work_features.notes,candidate.notes)
+					logger.debug("\tMatches updated with notes: %s",matches[found_uri])
+
+				if 'hubs' in resource:
+					# Check list of pre-identified hubs for the current search result, if that isn't 
+					# present, check to see if the current search result links back to the selected
+					# Work
+					if candidate_hubs and found_uri in candidate_hubs:
+						matches[found_uri]['hub'] = 1
 					else:
-						record_hubs = details_tree.xpath("/rdf:RDF/bf:Work/bf:expressionOf/@rdf:resource",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-						hubs[found_uri] = record_hubs
-
-				i = i + 2
+						logger.debug("\tHub hasExpression list: %s",candidate.has_expression)
+						if work_uri in candidate.has_expression:
+							matches[found_uri]['hub'] = 1
+				else:
+					hubs[found_uri] = list(candidate.expression_of)
 
-		except etree.XMLSyntaxError as lxml_error:
-			logger.error(placeholder_work_id)
-			logger.error(text_string)
-			logger.error(query_url)
-			logger.error(lxml_error)
-			logger.error(traceback.format_exc())
-			logger.error(details_content)
-			logger.error(details.status_code)
 		except Exception as e:
 			logger.error(placeholder_work_id)
 			logger.error(text_string)
@@ -489,229 +1495,479 @@ def searchForRecordLOC(placeholder_work_id,match_fields,resource,types,output_wr
 		results_by_title[text_string]['matches'] = matches
 		results_by_title[text_string]['hubs'] = hubs
 
-	logger.debug(f"\tScores for all search results: {results_by_title}")
+		if early_exit.hasCertainMatch(matches,work_features,resource,work_uri,candidate_hubs):
+			skipped_titles = work_features.titles[title_position+1:]
+			early_exit.recordSkipped(skipped_titles)
+			logger.debug("\tCertain match found for %s, skipping searches for %s",text_string,skipped_titles)
+			break
+
+	logger.debug("\tScores for all search results: %s",results_by_title)
 	selected_url, selected_name, selected_breakdown, match_not_found = findBestMatch(results_by_title)
-	logger.debug(f"\tBest match from search results: {selected_url}")
-	logger.debug(f"\tMatch not found: {match_not_found}")
+	if trace is not None:
+		trace['searches'].append({ 'resource': resource, 'matches': { title: results['matches'] for title, results in results_by_title.items() }, 'skipped_titles': list(skipped_titles), 'selected': selected_url, 'selected_title': selected_name, 'score': sum(selected_breakdown.values()) if selected_url else 0 })
+	logger.debug("\tBest match from search results: %s",selected_url)
+	logger.debug("\tMatch not found: %s",match_not_found)
 	if selected_url:
-		encoded_selected_name = urllib.parse.quote_plus(selected_name)
-		selected_query_url = f"{BASE_LC_URL}{encoded_selected_name}{RDFTYPES}&q=cs:{ENCODED_RESOURCE_URL}"
-		logger.debug(f"\tWriting results to spreadsheet: {placeholder_work_id}, {selected_name}, {selected_query_url}, {json.dumps(selected_breakdown)}, {selected_url}")
-		output_writer.writerow([placeholder_work_id,selected_name,selected_query_url,json.dumps(selected_breakdown),selected_url])
+		if len(skipped_titles) > 0:
+			selected_breakdown['skipped_searches'] = [getSearchUrl(title,type_names,resource) for title in skipped_titles]
+		selected_query_url = getSearchUrl(selected_name,type_names,resource)
+		selected_breakdown_json = json.dumps(selected_breakdown)
+		logger.debug("\tWriting results to spreadsheet: %s, %s, %s, %s, %s",placeholder_work_id,selected_name,selected_query_url,selected_breakdown_json,selected_url)
+		output_writer.writerow([placeholder_work_id,selected_name,selected_query_url,selected_breakdown_json,selected_url])
 		if 'hubs' in resource:
 			return selected_url, selected_name, None
 		else:
 			return selected_url, selected_name, results_by_title[selected_name]['hubs'][selected_url] if len(results_by_title[selected_name]['hubs'][selected_url]) > 0 else None
 
 	if match_not_found:
-		logger.debug(f"{placeholder_work_id}, {match_fields['titles'][0]}, {query_url},")
-		output_writer.writerow([placeholder_work_id,match_fields['titles'][0],query_url])
+		logger.debug("%s, %s, %s,",placeholder_work_id,work_features.titles[0],query_url)
+		output_writer.writerow([placeholder_work_id,work_features.titles[0],query_url])
 		return None, None, None
 
-# Search for a record in Wikidata by finding a listed contributor and searching through
-# their listed works to find the best title match.
-def searchForRecordWiki(placeholder_work_id,match_fields,cache_connection,output_writer):
+WIKIDATA_SEARCH_URL = "https://www.wikidata.org/w/api.php"
+WIKIDATA_SPARQL_URL = "https://query.wikidata.org/bigdata/namespace/wdq/sparql"
+wikidata_chunk_size = 50
+wikidata_values_size = 100
+wikidata_works_ttl = 604800
+
+def parseMarcKey(contributor):
+	split_contributor = contributor.split('$')
+	split_contributor.pop(0)
+	return { x[0]: x[1:] for x in split_contributor }
+
+def getEntityId(uri):
+	return uri[uri.rfind('/')+1:]
+
+# Run a query once for each group of values, with the group filled into its VALUES block, and
+# return the bindings from all of them
+def queryWikidataValues(build_query,values):
+	logger = logging.getLogger('reconciliation_logger')
+	bindings = []
+	for start in range(0,len(values),wikidata_values_size):
+		query_url = f"{WIKIDATA_SPARQL_URL}?format=json&query={urllib.parse.quote_plus(build_query(' '.join(values[start:start+wikidata_values_size])))}"
+		response = getRequest(query_url,Mime.JSON)
+		query_results = json.loads(response.content)
+		logger.debug("\tResults from query: %s",query_results)
+		if len(query_results['results']['bindings']) == 0:
+			request_coalescer.rememberEmpty(query_url,response)
+		bindings += query_results['results']['bindings']
+	return bindings
+
+# Find the works for each contributor, and store them in the cache in a hash named after the
+# contributor, which expires so that works added to Wikidata since are picked up. A contributor is found in Wikidata with the WorldCat Entity URI in $1 if there is
+# one, or else by searching for the name in $a. The works are the ones connected to the
+# contributor by the property for their top occupation (for example composer). Each step is
+# done with one query for all of the contributors, so that a chunk of Works only takes a
+# few queries no matter how many contributors it has.
+def resolveWikidataContributors(marc_contributors,cache_connection):
 	logger = logging.getLogger('reconciliation_logger')
-	BASE_WIKIDATA_URL = "https://www.wikidata.org/w/api.php"
-	BASE_WIKIDATA_SPARQL_URL = "https://query.wikidata.org/bigdata/namespace/wdq/sparql"
+	contributors_by_name = {}
+	for marc_contributor in marc_contributors:
+		contributors_by_name.setdefault(marc_contributor['a'],marc_contributor)
 
-	best_work_score = 0
-	best_work = None
-	best_work_uri = None
-	for contributor in match_fields['contributors']:
-		split_contributor = contributor.split('$')
-		split_contributor.pop(0)
-		logger.debug(f"\tContributor: {split_contributor}")
-		marc_contributor = { x[0]: x[1:] for x in split_contributor }
-		logger.debug(f"\tReformatted contributor: {marc_contributor}")
-		res = cache_connection.hget(marc_contributor['a'],'empty')
-
-		if res == 'True':
-			continue
-		else:
-			contributor_works = {}
-			contributor_found = False
-			if '1' in marc_contributor:
-				if 'https://id.oclc.org/worldcat/entity' in marc_contributor['1']:
-					ID_STRING = marc_contributor['1'][marc_contributor['1'].rfind('/')+1:]
-					SPARQL_QUERY = f"""SELECT ?contrib
+	names_by_oclc_id = {}
+	for name, marc_contributor in contributors_by_name.items():
+		if '1' in marc_contributor and 'https://id.oclc.org/worldcat/entity' in marc_contributor['1']:
+			names_by_oclc_id.setdefault(getEntityId(marc_contributor['1']),[]).append(name)
+
+	contributor_codes = {}
+	oclc_bindings = queryWikidataValues(lambda values: f"""SELECT ?contrib ?oclc_id
 WHERE
 {{
-  ?contrib wdt:P10832 "{ID_STRING}"
-}}"""
-					sparql_query_url = f"{BASE_WIKIDATA_SPARQL_URL}?format=json&query={urllib.parse.quote_plus(SPARQL_QUERY)}"
-					query_results = json.loads(getRequest(sparql_query_url,Mime.JSON).content)
-					logger.debug(f"\tContributor record from OCLC URI: {query_results}")
-					if len(query_results['results']['bindings']) > 0:
-						contributor_code = query_results['results']['bindings'][0]['contrib']['value']
-						contributor_code = contributor_code[contributor_code.rfind('/')+1:]
-						contributor_found = True
-
-			if not contributor_found:
-				ENCODED_CONTRIBUTOR = urllib.parse.quote_plus(marc_contributor['a'])
-				wikidata_query = f"{BASE_WIKIDATA_URL}?action=query&list=search&srsearch={ENCODED_CONTRIBUTOR}&format=json"
-				wikidata_search = json.loads(getRequest(wikidata_query,Mime.JSON).content)
-				logger.debug(f"\tSerach results for contributor: {wikidata_search}")
-				if len(wikidata_search['query']['search']) > 0:
-					contributor_code = wikidata_search['query']['search'][0]['title']
-				else:
-					contributor_code = None
-					logger.debug(f"\tNon-WorldCat Entity URL: {marc_contributor['a']}")
-			
-			if contributor_code:
-				OCCUPATION_QUERY = f"""SELECT ?occupation_properties
+  VALUES ?oclc_id {{ {values} }}
+  ?contrib wdt:P10832 ?oclc_id
+}}""",[f'"{oclc_id}"' for oclc_id in names_by_oclc_id])
+	for binding in oclc_bindings:
+		for name in names_by_oclc_id.get(binding['oclc_id']['value'],[]):
+			contributor_codes.setdefault(name,getEntityId(binding['contrib']['value']))
+
+	# Wikidata's search service can only look for one name at a time
+	for name in contributors_by_name:
+		if name not in contributor_codes:
+			wikidata_query = f"{WIKIDATA_SEARCH_URL}?action=query&list=search&srsearch={urllib.parse.quote_plus(name)}&format=json"
+			response = getRequest(wikidata_query,Mime.JSON)
+			wikidata_search = json.loads(response.content)
+			logger.debug("\tSearch results for contributor: %s",wikidata_search)
+			if len(wikidata_search['query']['search']) > 0:
+				contributor_codes[name] = wikidata_search['query']['search'][0]['title']
+			else:
+				request_coalescer.rememberEmpty(wikidata_query,response)
+				logger.debug("\tNo Wikidata entity found for: %s",name)
+
+	occupation_properties = {}
+	occupation_bindings = queryWikidataValues(lambda values: f"""SELECT ?contrib ?occupation_properties
 WHERE
 {{
-  wd:{contributor_code} wdt:P106 ?occupations .
+  VALUES ?contrib {{ {values} }}
+  ?contrib wdt:P106 ?occupations .
   ?occupations wdt:P1687 ?occupation_properties.
-}}"""
-				logger.debug(f"\tChecking contributor: {contributor_code}")
-				occupation_query_url = f"{BASE_WIKIDATA_SPARQL_URL}?format=json&query={urllib.parse.quote_plus(OCCUPATION_QUERY)}"
-				occupation_query_results = json.loads(getRequest(occupation_query_url,Mime.JSON).content)
-				logger.debug(f"\tContributor occupation: {occupation_query_results}")
-				occupation_property = occupation_query_results['results']['bindings']
-				if len(occupation_property) > 0:
-					occupation_property = occupation_property[0]['occupation_properties']['value']
-					occupation_property = occupation_property[occupation_property.rfind('/')+1:]
-					logger.debug(f"\tContributor occupation property: {occupation_property}")
-					WORKS_QUERY = f"""SELECT ?works ?worksLabel
+}}""",[f"wd:{contributor_code}" for contributor_code in dict.fromkeys(contributor_codes.values())])
+	for binding in occupation_bindings:
+		occupation_properties.setdefault(getEntityId(binding['contrib']['value']),getEntityId(binding['occupation_properties']['value']))
+	logger.debug("\tContributor occupation properties: %s",occupation_properties)
+
+	works_by_code = {}
+	works_bindings = queryWikidataValues(lambda values: f"""SELECT ?contrib ?works ?worksLabel
 WHERE
 {{
-  ?works wdt:{occupation_property} wd:{contributor_code} .
+  VALUES (?contrib ?occupation_property) {{ {values} }}
+  ?works ?occupation_property ?contrib .
   SERVICE wikibase:label {{ bd:serviceParam wikibase:language "[AUTO_LANGUAGE],mul,en". }}
-}}"""
-					works_query_url = f"{BASE_WIKIDATA_SPARQL_URL}?format=json&query={urllib.parse.quote_plus(WORKS_QUERY)}"
-					works_query_results = json.loads(getRequest(works_query_url,Mime.JSON).content)
-					logger.debug(f"\tResults from query for contributor works: {works_query_results}")
-					if len(works_query_results['results']['bindings']) > 0:
-						for w in works_query_results['results']['bindings']:
-							logger.debug(f"\tWork: {w}")
-							contributor_works[w['works']['value']] = w['worksLabel']['value']
-
-			logger.debug(f"\tContributor works: {contributor_works}")
-			if len(contributor_works) > 0:
-				cache_connection.hset(marc_contributor['a'], mapping=contributor_works)
-			else:
-				cache_connection.hset(marc_contributor['a'], mapping={ 'empty': 'True' })
+}}""",[f"(wd:{contributor_code} wdt:{occupation_property})" for contributor_code, occupation_property in occupation_properties.items()])
+	for binding in works_bindings:
+		works_by_code.setdefault(getEntityId(binding['contrib']['value']),{})[binding['works']['value']] = binding['worksLabel']['value']
+
+	pipeline = cache_connection.pipeline(transaction=False)
+	for name in contributors_by_name:
+		contributor_works = works_by_code.get(contributor_codes.get(name),{})
+		logger.debug("\tContributor works for %s: %s",name,contributor_works)
+		pipeline.delete(name)
+		if len(contributor_works) > 0:
+			pipeline.hset(name, mapping=contributor_works)
+		else:
+			pipeline.hset(name, mapping={ 'empty': 'True' })
+		pipeline.expire(name,wikidata_works_ttl)
+	pipeline.execute()
+
+# Works for the Wikidata search are read a chunk at a time, and the contributors of the whole
+# chunk that aren't in the cache yet are looked up together before any of them are searched.
+# If that fails, each Work looks up its own contributors as it is searched.
+def prefetchWikidataContributors(prepared_works,cache_connection):
+	logger = logging.getLogger('reconciliation_logger')
+
+	def resolveChunk(chunk):
+		contributors_by_name = {}
+		for sequence, work, context, replayed, work_fields in chunk:
+			if work_fields:
+				for contributor in work_fields[1]['contributors']:
+					marc_contributor = parseMarcKey(contributor)
+					if 'a' in marc_contributor:
+						contributors_by_name.setdefault(marc_contributor['a'],marc_contributor)
+
+		names = list(contributors_by_name)
+		pipeline = cache_connection.pipeline(transaction=False)
+		for name in names:
+			pipeline.exists(name)
+		uncached = [contributors_by_name[name] for name, cached in zip(names,pipeline.execute()) if not cached]
+
+		if len(uncached) > 0:
+			try:
+				resolveWikidataContributors(uncached,cache_connection)
+			except Exception as e:
+				logger.error(f"Error looking up contributors in Wikidata: {e}")
+				logger.error(traceback.format_exc())
 
-		logger.debug(f"\tContributor name: {marc_contributor['a']}")
-		for found_work in cache_connection.hscan_iter(marc_contributor['a']):
-			for t in match_fields['titles']:
-				l_dist = calculateLevenshteinDistance(t,found_work[1])
+	chunk = []
+	for prepared_work in prepared_works:
+		chunk.append(prepared_work)
+		if len(chunk) >= wikidata_chunk_size:
+			resolveChunk(chunk)
+			yield from chunk
+			chunk = []
+
+	resolveChunk(chunk)
+	yield from chunk
+
+# The works of a contributor, as they are listed in the contributor's hash, indexed by title so
+# that a local title is only compared to the works that could be close enough to match. A
+# title matches when its Levenshtein Distance is less than 10% of the length of the local
+# title, so only works whose titles are within that many characters in length are considered,
+# and when the local title is long enough, only those that also share enough of its character
+# bigrams for the distance to be that small. Identical titles are found without comparing.
+class ContributorWorks:
+	def __init__(self,works):
+		self.works = works
+		self.positions_by_title = {}
+		self.positions_by_length = {}
+		self.qgram_positions = {}
+		for position, (work_uri, work_title) in enumerate(works):
+			self.positions_by_title.setdefault(work_title,position)
+			self.positions_by_length.setdefault(len(work_title),[]).append(position)
+			for qgram, count in getQGrams(work_title).items():
+				self.qgram_positions.setdefault(qgram,[]).append((position,count))
+
+	def getCandidates(self,title,max_distance):
+		if getSharedQGramBound(len(title),0,max_distance) <= 0:
+			return [position for length in range(len(title) - max_distance,len(title) + max_distance + 1) for position in self.positions_by_length.get(length,[])]
+
+		shared = collections.Counter()
+		for qgram, count in getQGrams(title).items():
+			for position, work_count in self.qgram_positions.get(qgram,[]):
+				shared[position] += min(count,work_count)
+
+		candidates = []
+		for position, shared_count in shared.items():
+			work_title = self.works[position][1]
+			if abs(len(work_title) - len(title)) <= max_distance and shared_count >= getSharedQGramBound(len(title),len(work_title),max_distance):
+				candidates.append(position)
+		return candidates
+
+	# Returns the score, title and URI of the best matching work, taking the first work listed
+	# when several have the same score, along with how many titles were compared
+	@timed('scoring',scorer='ContributorWorks.findBestMatch')
+	def findBestMatch(self,titles):
+		best = None
+		compared = 0
+		for title_position, t in enumerate(titles):
+			if len(t) == 0:
+				continue
+
+			if t in self.positions_by_title:
+				candidate = (1.0, self.positions_by_title[t], title_position)
+				if best is None or candidate[0] > best[0] or (candidate[0] == best[0] and candidate[1:] < best[1:]):
+					best = candidate
+				continue
+
+			max_distance = getMaximumDistance(len(t) * 0.1)
+			for position in self.getCandidates(t,max_distance):
+				compared += 1
+				l_dist = calculateLevenshteinDistance(t,self.works[position][1],max_distance)
 				if l_dist < len(t) * 0.1:
-					logger.debug(f"\tTitle distance cutoff: {len(t) * 0.1}")
-					score_value = (len(t) - l_dist)/(len(t))
-					if score_value > best_work_score:
-						best_work_score = score_value
-						best_work = found_work[1]
-						best_work_uri = found_work[0]
+					candidate = ((len(t) - l_dist)/(len(t)), position, title_position)
+					if best is None or candidate[0] > best[0] or (candidate[0] == best[0] and candidate[1:] < best[1:]):
+						best = candidate
+
+		if best is None:
+			return None, compared
+
+		work_uri, work_title = self.works[best[1]]
+		return (best[0], work_title, work_uri), compared
+
+# Contributors' works are loaded from their hashes the first time they're needed and kept for
+# every later Work with the same contributor. Once the total number of works kept reaches the
+# limit, the contributors that were used least recently are dropped.
+class ContributorWorksCache:
+	def __init__(self,max_works):
+		self.max_works = max_works
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.total_works = 0
+		self.stats = { 'hits': 0, 'loaded': 0, 'evicted': 0, 'works': 0, 'compared': 0 }
+
+	def get(self,name,cache_connection):
+		with self.lock:
+			contributor_works = self.entries.get(name)
+			if contributor_works is not None:
+				self.entries.move_to_end(name)
+				self.stats['hits'] += 1
+				return contributor_works
+
+		contributor_works = ContributorWorks(list(cache_connection.hscan_iter(name)))
+		with self.lock:
+			if name not in self.entries:
+				self.entries[name] = contributor_works
+				self.total_works += len(contributor_works.works)
+				self.stats['loaded'] += 1
+				while self.total_works > self.max_works and len(self.entries) > 1:
+					evicted_name, evicted_works = self.entries.popitem(last=False)
+					self.total_works -= len(evicted_works.works)
+					self.stats['evicted'] += 1
+		return contributor_works
+
+	def findBestMatch(self,name,titles,cache_connection):
+		best_match, compared = self.get(name,cache_connection).findBestMatch(titles)
+		with self.lock:
+			self.stats['works'] += 1
+			self.stats['compared'] += compared
+		return best_match
+
+contributor_works_cache = ContributorWorksCache(1000000)
 
+# Search for a record in Wikidata by finding a listed contributor and searching through
+# their listed works to find the best title match.
+def searchForRecordWiki(placeholder_work_id,match_fields,cache_connection,output_writer,trace=None):
+	logger = logging.getLogger('reconciliation_logger')
 
+	best_work_score = 0
+	best_work = None
+	best_work_uri = None
+	for contributor in match_fields['contributors']:
+		marc_contributor = parseMarcKey(contributor)
+		logger.debug("\tReformatted contributor: %s",marc_contributor)
+		if not cache_connection.exists(marc_contributor['a']):
+			resolveWikidataContributors([marc_contributor],cache_connection)
+
+		if cache_connection.hget(marc_contributor['a'],'empty') == 'True':
+			if trace is not None:
+				trace['searches'].append({ 'contributor': marc_contributor['a'], 'found': False })
+			continue
+
+		logger.debug("\tContributor name: %s",marc_contributor['a'])
+		best_match = contributor_works_cache.findBestMatch(marc_contributor['a'],match_fields['titles'],cache_connection)
+		logger.debug("\tBest match among contributor works: %s",best_match)
+		if trace is not None:
+			trace['searches'].append({ 'contributor': marc_contributor['a'], 'found': True, 'best_match': best_match })
+		if best_match and best_match[0] > best_work_score:
+			best_work_score, best_work, best_work_uri = best_match
+
+
+	match_fields_json = json.dumps(match_fields)
 	if best_work_score > 0 and best_work and best_work_uri:
-		logger.debug(f"\tOutputting found: {placeholder_work_id}, {json.dumps(match_fields)}, {best_work}, {best_work_score}, {best_work_uri}")
-		output_writer.writerow([placeholder_work_id,json.dumps(match_fields),best_work,best_work_score,best_work_uri])
+		logger.debug("\tOutputting found: %s, %s, %s, %s, %s",placeholder_work_id,match_fields_json,best_work,best_work_score,best_work_uri)
+		output_writer.writerow([placeholder_work_id,match_fields_json,best_work,best_work_score,best_work_uri])
 		return best_work_uri, best_work
 	else:
-		logger.debug(f"\tOutputting not found: {placeholder_work_id}, {json.dumps(match_fields)}")
-		output_writer.writerow([placeholder_work_id,json.dumps(match_fields)])
+		logger.debug("\tOutputting not found: %s, %s",placeholder_work_id,match_fields_json)
+		output_writer.writerow([placeholder_work_id,match_fields_json])
 		return None, None
 
-# Find all the contributor labels, save the element that contains them, search for the best match
-# in LOC, then use the URI for that as the id for all instances where the name appears. If there
-# is already a non-example.org URI used in an instance, don't search and just push that to all
-# other instances instead.
-def populateContributors(contributors):
+# Take the type of each contributor name from the Contributions grouped under it in a
+# DocumentIndex. If there is already a non-example.org URI used for a name, keep that as the
+# id for the name. This can be called on several indexes in turn to build up one set of
+# mappings.
+def collectContributorNames(contributions_by_name,name_mappings):
 	logger = logging.getLogger('reconciliation_logger')
-	BASE_LC_URL = 'https://id.loc.gov/search/?q='
-	ENCODED_RESOURCE_URL = urllib.parse.quote_plus('http://id.loc.gov/authorities/names')		
-
-	name_mappings = {}
-	for c in contributors:
-		c_name = c.xpath("./bf:agent/bf:Agent/rdfs:label/text()",namespaces={"bf": Namespaces.BF,"rdfs": Namespaces.RDFS})
-		logger.debug(f"\tContributor name: {c_name}")
-		c_type = c.xpath("./bf:agent/bf:Agent/rdf:type/@rdf:resource",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-		logger.debug(f"\tContributor type: {c_type}")
-
-		if c_name[0] not in name_mappings:
-			name_mappings[c_name[0]] = { 'type': c_type[0], 'elements': [ c ] }
-		else:
-			name_mappings[c_name[0]]['elements'].append(c)
+	for c_name, contributions in contributions_by_name.items():
+		logger.debug("\tContributor name: %s",c_name)
+		for c in contributions:
+			if c_name not in name_mappings:
+				c_type = XPaths.AGENT_TYPE(c)
+				logger.debug("\tContributor type: %s",c_type)
+				name_mappings[c_name] = { 'type': c_type[0] }
+
+			if 'id' in name_mappings[c_name]:
+				break
 
-		if 'id' not in name_mappings[c_name[0]]:
-			c_id = c.xpath("./bf:agent/bf:Agent/@rdf:about",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-			logger.debug(f"\tContributor id: {c_id}")
+			c_id = XPaths.AGENT_ID(c)
+			logger.debug("\tContributor id: %s",c_id)
 			if 'example.org' not in c_id[0]:
-				name_mappings[c_name[0]]['id'] = c_id[0]
+				name_mappings[c_name]['id'] = c_id[0]
+
+	return name_mappings
+
+# Search LCNAF for a name and return the URI of the closest match, if any is close enough
+def findNameMatch(name,search_on):
+	logger = logging.getLogger('reconciliation_logger')
+	if logger.isEnabledFor(logging.DEBUG):
+		logger.debug("\tQUERYING LCNAF: %s",getSearchUrl(name,[search_on],'http://id.loc.gov/authorities/names'))
+
+	best_match_score = None
+	best_match_url = None
+	for found_uri, details_title in catalog.searchNames(name,search_on):
+		logger.debug("\tFound %s",name)
+		logger.debug("\t%s",found_uri)
+		logger.debug("\tLCNAF record names: %s",details_title)
+		for title_variant in details_title:
+			logger.debug("\tTitle: %s",title_variant)
+			l_dist = calculateLevenshteinDistance(name,title_variant,getMaximumDistance(len(name) * 0.1))
+			logger.debug("Distance: %s",l_dist)
+			if l_dist < (len(name) * 0.1):
+				if best_match_score:
+					if l_dist < best_match_score:
+						best_match_score = l_dist
+						best_match_url = found_uri
+				else:
+					best_match_score = l_dist
+					best_match_url = found_uri
 
+		if best_match_score and best_match_score == 0:
+			break
+
+	return best_match_url
+
+# Matches are kept in Redis under the name's type and the name exactly as it is written, along
+# with the names that had no match, so a name is only ever searched for once. The match found
+# depends on the exact name, so names that only differ in case or spacing are kept apart.
+NO_NAME_MATCH = 'none'
+name_match_ttl = 2592000
+name_no_match_ttl = 604800
+name_resolution_workers = 8
+
+def getNameKey(name,search_on):
+	return f"lcnaf:{search_on}:{name}"
+
+# For each name collected by collectContributorNames that doesn't have an id yet, search for
+# the best match in LOC and use the URI for that as the id. Names that aren't in the cache
+# are searched for concurrently, sharing the rate limit for id.loc.gov.
+@timed('contributor_names')
+def populateContributors(name_mappings,cache_connection):
+	logger = logging.getLogger('reconciliation_logger')
 	logger.debug(name_mappings)
+	unresolved_names = {}
 	for name in name_mappings:
-		logger.debug(f"\tProcessing: {name}")
-		logger.debug(f"\tContents: {name_mappings[name]}")
+		logger.debug("\tProcessing: %s",name)
+		logger.debug("\tContents: %s",name_mappings[name])
 
-		if 'id' not in name_mappings[name]:			
+		if 'id' not in name_mappings[name]:
 			if 'Person' in name_mappings[name]['type']:
-				search_on = 'PersonalName'
+				unresolved_names[name] = 'PersonalName'
 			else:
-				search_on = 'CorporateName'
-			RDFTYPES = f"+rdftype:{search_on}"
-			ENCODED_TEXT_STRING = urllib.parse.quote_plus(name)
-			query_url = f"{BASE_LC_URL}{ENCODED_TEXT_STRING}{RDFTYPES}&q=cs:{ENCODED_RESOURCE_URL}"
-			logger.debug(f"\tQUERYING LCNAF: {query_url}")
-
-			best_match_score = None
-			best_match_url = None
+				unresolved_names[name] = 'CorporateName'
+
+	names = list(unresolved_names)
+	missing_names = []
+	for i in range(0,len(names),1000):
+		batch = names[i:i+1000]
+		for name, cached_match in zip(batch,cache_connection.mget([getNameKey(name,unresolved_names[name]) for name in batch])):
+			if cached_match is None:
+				missing_names.append(name)
+			elif cached_match != NO_NAME_MATCH:
+				name_mappings[name]['id'] = cached_match
+	logger.debug("\tLCNAF matches cached for %s of %s names",len(names) - len(missing_names),len(names))
+
+	pipeline = cache_connection.pipeline(transaction=False)
+	with concurrent.futures.ThreadPoolExecutor(max_workers=name_resolution_workers,thread_name_prefix='LCNAF') as executor:
+		futures = [executor.submit(findNameMatch,name,unresolved_names[name]) for name in missing_names]
+		for name, future in zip(missing_names,futures):
+			search_on = unresolved_names[name]
 			try:
-				results_tree = etree.HTML(getRequest(query_url,Mime.HTML).content)
-				result_table = results_tree.xpath("//table[@class='id-std']/tbody/tr")
-				i = 0
-
-				while i < len(result_table):
-					logger.debug(f"\tFound {name}")
-					found_uri = 'http://id.loc.gov' + result_table[i].xpath("./td/a/@href")[0]
-					logger.debug(f"\t{found_uri}")
-					details_tree = etree.XML(getRequest(f"{found_uri.replace('http','https')}.marcxml.xml",Mime.MARCXML).content)
-					if search_on == 'PersonalName':
-						tag_check = "@tag='100' or @tag='400'"
-					else:
-						tag_check = "@tag='110' or @tag='410'"
-					details_title = details_tree.xpath(f"/marcxml:record/marcxml:datafield[{tag_check}]/marcxml:subfield[@code='a']/text()",namespaces={"marcxml": Namespaces.MARCXML})
-					logger.debug(f"\tLCNAF record names: {details_title}")
-					for title_variant in details_title:
-						logger.debug(f"\tTitle: {title_variant}")
-						l_dist = calculateLevenshteinDistance(name,title_variant)
-						logger.debug(f"Distance: {l_dist}")
-						if l_dist < (len(name) * 0.1):
-							if best_match_score:
-								if l_dist < best_match_score:
-									best_match_score = l_dist
-									best_match_url = found_uri
-							else:
-								best_match_score = l_dist
-								best_match_url = found_uri
-
-					if best_match_score and best_match_score == 0:
-						break
-					else:
-						i += 2
+				best_match_url = future.result()
 			except Exception as e:
 				logger.error(name)
-				logger.error(query_url)
+				logger.error(getSearchUrl(name,[search_on],'http://id.loc.gov/authorities/names'))
 				logger.error(e)
 				logger.error(traceback.format_exc())
+				continue
 
 			if best_match_url:
 				name_mappings[name]['id'] = best_match_url
+				pipeline.set(getNameKey(name,search_on),best_match_url,ex=name_match_ttl)
+			else:
+				pipeline.set(getNameKey(name,search_on),NO_NAME_MATCH,ex=name_no_match_ttl)
+
+			if len(pipeline) >= 1000:
+				pipeline.execute()
+	pipeline.execute()
 
-	for n in name_mappings:
-		logger.debug(f"\tTrying to add URI for name: {n}")
-		logger.debug(f"\tName object: {name_mappings[n]}")
+# Use the ids found for each name as the URI for all instances where the name appears
+def applyContributorNames(contributions_by_name,name_mappings):
+	logger = logging.getLogger('reconciliation_logger')
+	for n, contributions in contributions_by_name.items():
+		logger.debug("\tTrying to add URI for name: %s",n)
+		logger.debug("\tName object: %s",name_mappings[n])
 		if 'id' in name_mappings[n]:
-			for element in name_mappings[n]['elements']:
-				element_id = element.xpath("./bf:agent/bf:Agent/@rdf:about",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
+			for element in contributions:
+				element_id = XPaths.AGENT_ID(element)
 				if 'example.org' in element_id[0]:
-					agent = element.xpath("./bf:agent/bf:Agent",namespaces={"bf": Namespaces.BF})
+					agent = XPaths.AGENT(element)
 					agent[0].set(f"{{{Namespaces.RDF}}}about",name_mappings[n]['id'])
 
+# Lookups into a set of top level elements that would otherwise need a search of the whole
+# document for every Work. Built once, in a single pass, it maps each Work URI to the
+# bf:instanceOf links that point at it, and groups the Contributions of each Work by the
+# contributor's name.
+class DocumentIndex:
+	def __init__(self,elements):
+		self.instance_links = {}
+		self.contributions = {}
+		for element in elements:
+			if element.tag == f"{{{Namespaces.BF}}}Instance":
+				for link in XPaths.INSTANCE_LINKS(element):
+					self.instance_links.setdefault(link.get(f"{{{Namespaces.RDF}}}resource"),[]).append(link)
+			elif element.tag == f"{{{Namespaces.BF}}}Work":
+				for contribution in XPaths.CONTRIBUTIONS(element):
+					name = XPaths.AGENT_LABEL(contribution)
+					if len(name) > 0:
+						self.contributions.setdefault(name[0],[]).append(contribution)
+
+	# Point every Instance linked to one Work URI at another one, keeping the index current
+	def relinkInstances(self,old_uri,new_uri):
+		links = self.instance_links.pop(old_uri,[])
+		for link in links:
+			link.set(f"{{{Namespaces.RDF}}}resource",new_uri)
+		if len(links) > 0:
+			self.instance_links.setdefault(new_uri,[]).extend(links)
+
 def clearBlankText(text_array):
 	return " ".join([x for x in text_array if x.strip() != ''])
 
@@ -720,18 +1976,23 @@ def init(args):
 		raise Exception("Input file must be an XML file")
 
 	logfile_name = f"{args.output}{SLASH}{args.input.rsplit('/',1)[1][:-4]}_{args.source}_err.log"
-	#	log_formatter = logging.Formatter('%(asctime)s [%(levelname)s] (%(threadName)-10s) %(message)s')
 	if args.verbose:
 		log_level = 'DEBUG'
 	else:
 		log_level = 'WARNING'
 
+	# Log lines from concurrent Works are interleaved, so label them with the thread they came from
+	if args.workers > 1:
+		log_format = '%(asctime)s [%(levelname)s] (%(threadName)-10s) %(message)s'
+	else:
+		log_format = '%(asctime)s [%(levelname)s] %(message)s'
+
 	LOGGING_CONFIG = {
 		'version': 1,
 		'disable_existing_loggers': False,
 		'formatters': {
 			'default': {
-				'format': '%(asctime)s [%(levelname)s] %(message)s'
+				'format': log_format
 			}
 		},
 		'handlers': {
@@ -778,113 +2039,772 @@ def init(args):
 			time.sleep(5)
 			logger.info('Retrying cache initialization')
 
+	global http_session
+	if config.has_section('connection_pools') or config.has_section('host_overrides'):
+		host_pool_sizes = { host: config.getint('connection_pools',host) for host in config.options('connection_pools') if host != 'default' } if config.has_section('connection_pools') else {}
+		host_overrides = dict(config.items('host_overrides')) if config.has_section('host_overrides') else {}
+		http_session = createSession(config.getint('connection_pools','default',fallback=10),host_pool_sizes,host_overrides)
+
+	# Rate limits are kept in their own database so that runs against either source share them
+	global rate_limiter
+	rate_limit_db = config.get('rate_limits','db',fallback=config.get('redis','loc_db'))
+	host_limits = dict(DEFAULT_RATE_LIMITS)
+	if config.has_section('rate_limits'):
+		host_limits.update({ host: limit for host, limit in config.items('rate_limits') if host != 'db' })
+	rate_limiter = HostRateLimiter(RedisStorage(f"redis://{config.get('redis','host')}:{config.get('redis','port')}/{rate_limit_db}"),{ host: parseRateLimit(limit) for host, limit in host_limits.items() },redis.Redis(host=config.get('redis','host'), port=config.get('redis','port'), db=rate_limit_db, decode_responses=True))
+
+	# The local catalog is read instead of searching id.loc.gov
+	global catalog
+	if args.catalog == Catalogs.local:
+		catalog = LocalCatalog(config.get('local_catalog','path',fallback='loc_catalog.db'),config.getint('local_catalog','candidates',fallback=25),config.getint('local_catalog','query_terms',fallback=12))
+
+	global agent_label_ttl, agent_label_executor
+	agent_label_ttl = config.getint('agent_labels','ttl',fallback=2592000)
+	if config.has_option('agent_labels','fetch_workers'):
+		agent_label_executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.getint('agent_labels','fetch_workers'),thread_name_prefix='AgentLabel')
+
+	global name_match_ttl, name_no_match_ttl, name_resolution_workers
+	name_match_ttl = config.getint('name_resolution','ttl',fallback=2592000)
+	name_no_match_ttl = config.getint('name_resolution','no_match_ttl',fallback=604800)
+	name_resolution_workers = config.getint('name_resolution','workers',fallback=8)
+
+	global wikidata_chunk_size, wikidata_values_size, wikidata_works_ttl
+	wikidata_chunk_size = config.getint('wikidata_batch','chunk_size',fallback=50)
+	wikidata_values_size = config.getint('wikidata_batch','values',fallback=100)
+	wikidata_works_ttl = config.getint('wikidata_batch','ttl',fallback=config.getint('response_cache','ttl',fallback=604800))
+
+	global contributor_works_cache
+	contributor_works_cache = ContributorWorksCache(config.getint('wikidata_batch','max_works',fallback=1000000))
+
+	global run_metrics, metrics_enabled, metrics_interval, metrics_prometheus
+	run_metrics = RunMetrics()
+	metrics_enabled = config.getboolean('metrics','enabled',fallback=True)
+	metrics_interval = config.getint('metrics','interval',fallback=60)
+	metrics_prometheus = config.getboolean('metrics','prometheus',fallback=False)
+
+	global output_compress, output_flush_interval
+	output_compress = config.getboolean('output','compress',fallback=False)
+	output_flush_interval = config.getfloat('output','flush_interval',fallback=10)
+
+	global work_scheduler
+	work_scheduler = WorkScheduler(config.get('scheduling','order',fallback='document'),config.getint('scheduling','window',fallback=1000))
+
+	global candidate_pruner
+	candidate_pruner = CandidatePruner(config.get('candidate_pruning','mode',fallback='off'),config.getint('candidate_pruning','top_k',fallback=5))
+
+	global early_exit
+	early_exit = EarlyExitPolicy(config.getboolean('early_exit','enabled',fallback=True),config.getfloat('early_exit','certain_ratio',fallback=1.0))
+
+	# Features are stored compressed, so like the response cache they need a connection that doesn't decode
+	global feature_cache
+	feature_connection = None
+	if config.getboolean('feature_cache','enabled',fallback=True):
+		feature_connection = redis.Redis(host=config.get('redis','host'), port=config.get('redis','port'), db=config.get('feature_cache','db',fallback=cache_connection.connection_pool.connection_kwargs['db']))
+	feature_cache = CandidateFeatureCache(feature_connection,args.catalog.value,config.getint('feature_cache','ttl',fallback=2592000),config.getint('feature_cache','max_entries',fallback=10000))
+
+	global request_coalescer
+	request_coalescer = RequestCoalescer(config.getint('negative_cache','ttl',fallback=86400),config.getint('negative_cache','max_entries',fallback=10000))
+
+	# Response bodies are stored compressed, so they need a connection that doesn't decode
+	global response_cache
+	if config.getboolean('response_cache','enabled',fallback=True):
+		response_connection = redis.Redis(host=config.get('redis','host'), port=config.get('redis','port'), db=config.get('response_cache','db',fallback=cache_connection.connection_pool.connection_kwargs['db']))
+		response_cache = ResponseCache(response_connection,config.getint('response_cache','ttl',fallback=604800),config.getint('response_cache','stale_ttl',fallback=2592000),config.getint('response_cache','max_size',fallback=1073741824))
+
 	os.makedirs(args.output,exist_ok=True)
 
+	global work_tracer
+	if config.getboolean('trace','enabled',fallback=False):
+		below = config.getfloat('trace','below',fallback=None)
+		above = config.getfloat('trace','above',fallback=None)
+		work_tracer = WorkTracer(f"{args.output}{SLASH}{args.input.rsplit('/',1)[1][:-4]}_{args.source}_trace.jsonl",args.resume,config.getint('trace','every',fallback=1),below,above)
+
 	return cache_connection
 
-def reconcileWorks(args):
-	cache_connection = init(args)
+# Stands in for the csv writer while a Work is being reconciled, so that rows produced on a
+# worker thread can be written out later in document order.
+class RowBuffer:
+	def __init__(self):
+		self.rows = []
+
+	def writerow(self,row):
+		self.rows.append(row)
+
+# Select identifying characteristics of a Work to search on. Nothing that is returned refers
+# back to the tree, so a worker thread never reads from the document while it is being edited.
+def getMatchFields(work,source):
+	placeholder_work_id = XPaths.WORK_ID(work)[0]
+	work_title = XPaths.WORK_TITLE_PARTS(work)
+	work_title_text = clearBlankText(work_title)
+	work_types = XPaths.TYPES(work)
+	uniform_work_title = XPaths.UNIFORM_TITLE(work)
+
+	variant_titles = XPaths.VARIANT_TITLES(work)
+	variant_titles_text = [clearBlankText(XPaths.TITLE_PARTS(variant_title)) for variant_title in variant_titles]
+
+	search_titles = [work_title_text]
+	if variant_titles_text:
+		search_titles += variant_titles_text
+
+	if source == Sources.loc:
+		match_fields = getWorkFeatures(search_titles,work)
+
+	elif source == Sources.wikidata:
+		match_fields = { 'titles': search_titles, 'contributors': XPaths.CONTRIBUTIONS(work) }
+		marc_keys = []
+		found_primary = False
+		for contributor in match_fields['contributors']:
+			contributor_labels = XPaths.AGENT_MARC_KEY(contributor)
+
+			contributor_types = XPaths.TYPES(contributor)
+			if 'http://id.loc.gov/ontologies/bibframe/PrimaryContribution' in contributor_types:
+				match_fields['contributors'] = contributor_labels
+				found_primary = True
+				break
+			else:
+				marc_keys += contributor_labels
+
+		if not found_primary:
+			match_fields['contributors'] = marc_keys
+
+	return placeholder_work_id, match_fields, work_types, uniform_work_title
+
+# Structured trace of the scoring decisions made for each Work, written as a line of JSON per
+# Work: the scores of every candidate for each title searched, the searches skipped, and the
+# match selected (or, for Wikidata, the best work found for each contributor). Only every
+# n-th Work is traced, and of those only the ones whose match scored below or above the given
+# scores if either is set, with Works without a match scoring 0. When tracing is off, nothing
+# is gathered at all. A resumed run adds to the trace of the run it continues.
+class WorkTracer:
+	def __init__(self,path,resume,every,below,above):
+		self.trace_file = open(path,'a' if resume else 'w') if path else None
+		self.every = max(every,1)
+		self.below = below
+		self.above = above
+		self.lock = threading.Lock()
+		self.started = 0
+		self.stats = { 'sampled': 0, 'written': 0 }
+
+	def start(self,placeholder_work_id,source):
+		if self.trace_file is None:
+			return None
+
+		with self.lock:
+			self.started += 1
+			if (self.started - 1) % self.every != 0:
+				return None
+			self.stats['sampled'] += 1
+		return { 'work': placeholder_work_id, 'source': source.value, 'searches': [] }
+
+	# The score of the match selected for the Work itself, leaving out any Hub
+	def getScore(self,trace):
+		scores = [search['score'] for search in trace['searches'] if search.get('resource') == 'http://id.loc.gov/resources/works']
+		scores += [search['best_match'][0] for search in trace['searches'] if search.get('best_match')]
+		return max(scores) if len(scores) > 0 else 0
+
+	def isSelected(self,score):
+		if self.below is None and self.above is None:
+			return True
+		return (self.below is not None and score < self.below) or (self.above is not None and score > self.above)
+
+	def finish(self,trace,work_uri,hub_uri):
+		trace['score'] = self.getScore(trace)
+		if not self.isSelected(trace['score']):
+			return
+
+		trace['work_uri'] = work_uri
+		trace['hub_uri'] = hub_uri
+		line = json.dumps(trace)
+		with self.lock:
+			self.trace_file.write(line + '\n')
+			self.stats['written'] += 1
+
+	def close(self):
+		if self.trace_file:
+			self.trace_file.close()
+
+work_tracer = WorkTracer(None,False,1,None,None)
+
+# Run the searches for a single Work. Nothing here touches the input tree, so this can be
+# run on a worker thread; the rows for the spreadsheet are buffered and returned alongside
+# the selected URIs so that the caller can apply them.
+@timed('work')
+def reconcileWork(placeholder_work_id,match_fields,work_types,uniform_work_title,source,cache_connection):
 	logger = logging.getLogger('reconciliation_logger')
-	start_time = datetime.datetime.now()
-	
-	parser = etree.XMLParser(remove_blank_text=True)
-	tree = etree.parse(args.input, parser)
-	root = tree.getroot()
-	works = root.xpath('/rdf:RDF/bf:Work', namespaces={ "rdf": Namespaces.RDF, "bf": Namespaces.BF })
-
-	master_contributor_list = root.xpath('/rdf:RDF/bf:Work/bf:contribution/bf:Contribution', namespaces={ "rdf": Namespaces.RDF, "bf": Namespaces.BF })
-	populateContributors(master_contributor_list)
-
-	with open(f"{args.output}{SLASH}{args.input.rsplit('/',1)[1][:-4]}_{args.source}.tsv",'w') as outfile:
-		writer = csv.writer(outfile,delimiter='\t')
-
-		for work in works:
-			# Select identifying characteristics of Work, and search based on those values
-			placeholder_work_id = work.xpath("./@rdf:about", namespaces={ "rdf": Namespaces.RDF })[0]
-			logger.debug(f"Processing new Work with placeholder id: {placeholder_work_id}")
-			work_title = work.xpath("./bf:title/bf:Title/bf:*/text()", namespaces={ "bf": Namespaces.BF })
-			work_title_text = clearBlankText(work_title)
-			work_types = work.xpath("./rdf:type/@rdf:resource", namespaces={ "rdf": Namespaces.RDF })
-			logger.debug(f"Found work types: {work_types}")
-			uniform_work_title = work.xpath("./bf:expressionOf/bf:Hub/bf:title/bf:Title/bf:mainTitle/text()", namespaces={ "bf": Namespaces.BF })
-
-			variant_titles = work.xpath("./bf:title/bf:VariantTitle", namespaces={ "bf": Namespaces.BF })
-			variant_titles_text = [clearBlankText(variant_title.xpath("./bf:*/text()", namespaces={ "bf": Namespaces.BF })) for variant_title in variant_titles]
-
-			contributors = work.xpath("./bf:contribution/bf:Contribution", namespaces={ "bf": Namespaces.BF })
+	logger.debug("Processing new Work with placeholder id: %s",placeholder_work_id)
+	logger.debug("Found work types: %s",work_types)
+	output_buffer = RowBuffer()
+	found_hub_uri = None
+	trace = work_tracer.start(placeholder_work_id,source)
+
+	if source == Sources.loc:
+		# Find best match for Work, and if that Work has any linked Hubs, add that to our list of Hubs to check
+		found_work_uri, found_work_title, found_work_associated_hubs = searchForRecordLOC(placeholder_work_id,match_fields,'http://id.loc.gov/resources/works',work_types,output_buffer,cache_connection,trace=trace)
+
+		if len(uniform_work_title) > 0:
+			match_fields = match_fields._replace(titles=tuple(uniform_work_title) + match_fields.titles)
+
+		found_hub_uri, found_work_title, trash = searchForRecordLOC(placeholder_work_id,match_fields,'http://id.loc.gov/resources/hubs',['http://id.loc.gov/ontologies/bibframe/Work','http://id.loc.gov/ontologies/bibframe/Hub'],output_buffer,cache_connection,found_work_uri,found_work_associated_hubs,trace)
+
+	elif source == Sources.wikidata:
+		found_work_uri, found_work_title = searchForRecordWiki(placeholder_work_id,match_fields,cache_connection,output_buffer,trace)
+		logger.debug("Wikidata search does not support hubs")
+
+	if trace is not None:
+		work_tracer.finish(trace,found_work_uri,found_hub_uri)
+
+	return { 'placeholder_work_id': placeholder_work_id, 'work_uri': found_work_uri, 'work_title': found_work_title, 'hub_uri': found_hub_uri, 'rows': output_buffer.rows }
+
+# Write out the spreadsheet rows for a reconciled Work and make the matching edits to the
+# Work and to the Instances that point at it, found through a DocumentIndex. If a Hub was
+# found, a new Work for it is returned so the caller can add it to the output. This is
+# always called from the main thread, in document order.
+def applyReconciliation(work,index,reconciliation,output_writer):
+	placeholder_work_id = reconciliation['placeholder_work_id']
+	found_work_uri = reconciliation['work_uri']
+	found_work_title = reconciliation['work_title']
+	found_hub_uri = reconciliation['hub_uri']
+
+	with run_metrics.timer('output',format='tsv'):
+		output_writer.writerows(reconciliation['rows'])
+
+	# Make Instances point to new URI
+	if found_work_uri:
+		work.set('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about',found_work_uri)
+		index.relinkInstances(placeholder_work_id,found_work_uri)
+
+	# Add a new Work for a found Hub that points back at the Work it was derived from
+	if found_hub_uri:
+		expression_of = etree.SubElement(work,f"{{{Namespaces.BF}}}expressionOf")
+		expression_of.set(f"{{{Namespaces.RDF}}}resource",found_hub_uri)
+
+		new_hub = etree.Element(f"{{{Namespaces.BF}}}Work")
+		new_hub.set(f"{{{Namespaces.RDF}}}about",found_hub_uri)
+		hub_type = etree.SubElement(new_hub,f"{{{Namespaces.RDF}}}type")
+		hub_type.set(f"{{{Namespaces.RDF}}}resource","http://id.loc.gov/ontologies/bibframe/Hub")
+		hub_title = etree.SubElement(new_hub,f"{{{Namespaces.BF}}}title")
+		hub_Title = etree.SubElement(hub_title,f"{{{Namespaces.BF}}}Title")
+		hub_mainTitle = etree.SubElement(hub_Title,f"{{{Namespaces.BF}}}mainTitle")
+		hub_mainTitle.text = found_work_title
+		has_expression = etree.SubElement(new_hub,f"{{{Namespaces.BF}}}hasExpression")
+		has_expression.set(f"{{{Namespaces.RDF}}}resource", found_work_uri if found_work_uri else placeholder_work_id)
+		return new_hub
+
+	return None
+
+# Durable record of the decisions made during a run, so a run that stops part way through can
+# be picked up again with --resume. The contributor URIs found by populateContributors and the
+# reconciliation of each Work (the selected Work and Hub along with the spreadsheet rows and
+# their score breakdowns) are each written as a line of JSON and flushed to disk as soon as
+# they are final. When resuming, the recorded decisions are replayed instead of searching
+# again, and anything cut off by the failure is discarded.
+class ReconciliationJournal:
+	def __init__(self,path,resume):
+		self.completed = {}
+		self.name_mappings = None
+
+		valid_length = 0
+		if resume and os.path.exists(path):
+			with open(path,'rb') as journal_file:
+				for line in journal_file:
+					try:
+						entry = json.loads(line)
+					except ValueError:
+						break
+					if 'contributors' in entry:
+						self.name_mappings = entry['contributors']
+					else:
+						self.completed[entry['work']['placeholder_work_id']] = entry['work']
+					valid_length += len(line)
+
+		self.journal_file = open(path,'r+b' if valid_length > 0 else 'wb')
+		self.journal_file.truncate(valid_length)
+		self.journal_file.seek(valid_length)
+
+	def write(self,entry):
+		self.journal_file.write(json.dumps(entry).encode('utf-8') + b'\n')
+		self.journal_file.flush()
+		os.fsync(self.journal_file.fileno())
+
+	def recordContributors(self,name_mappings):
+		self.name_mappings = name_mappings
+		self.write({ 'contributors': name_mappings })
+
+	def record(self,reconciliation):
+		self.write({ 'work': reconciliation })
+
+	def getCompleted(self,work):
+		return self.completed.get(XPaths.WORK_ID(work)[0])
+
+	def close(self):
+		self.journal_file.close()
+
+# Works can be reconciled grouped by their primary contributor and title instead of in document
+# order, so that Works by the same contributor are searched one after another while the
+# records, agent labels and contributor works they share are still cached. Works are gathered
+# a window at a time and sorted within it, or all at once if the window is 0. Either way, the
+# results are still written out in document order.
+class WorkScheduler:
+	ORDERS = ['document','contributor']
+
+	def __init__(self,order,window):
+		if order not in self.ORDERS:
+			raise Exception(f"Unknown scheduling order {order}, expected one of {self.ORDERS}")
+		self.order = order
+		self.window = window
+
+	def getKey(self,prepared_work):
+		sequence, work, context, replayed, work_fields = prepared_work
+		if not work_fields:
+			return ('', '', sequence)
+
+		match_fields = work_fields[1]
+		contributor = ''
+		if isinstance(match_fields,WorkFeatures):
+			names = [name for name, contributor_type in match_fields.contributors if name and contributor_type] + [name for name, contributor_type in match_fields.contributors if name]
+			contributor = names[0] if len(names) > 0 else ''
+		elif len(match_fields['contributors']) > 0:
+			contributor = parseMarcKey(match_fields['contributors'][0]).get('a','')
+
+		title = match_fields.titles[0] if isinstance(match_fields,WorkFeatures) else match_fields['titles'][0]
+		return (' '.join(contributor.casefold().split()), ' '.join(title.casefold().split()), sequence)
+
+	def schedule(self,prepared_works):
+		if self.order == 'document':
+			yield from prepared_works
+			return
+
+		window = []
+		for prepared_work in prepared_works:
+			window.append(prepared_work)
+			if self.window > 0 and len(window) >= self.window:
+				yield from sorted(window,key=self.getKey)
+				window = []
+		yield from sorted(window,key=self.getKey)
+
+work_scheduler = WorkScheduler('document',1000)
+
+# The share of lookups in each of the run's caches that were answered without a request
+def getCacheHitRates():
+	feature_lookups = feature_cache.stats['memory_hits'] + feature_cache.stats['redis_hits'] + feature_cache.stats['misses']
+	contributor_works_lookups = contributor_works_cache.stats['hits'] + contributor_works_cache.stats['loaded']
+	agent_label_lookups = agent_label_stats['hits'] + agent_label_stats['misses']
+	hit_rates = {
+		'candidate_features': (feature_cache.stats['memory_hits'] + feature_cache.stats['redis_hits']) / feature_lookups if feature_lookups > 0 else 0,
+		'contributor_works': contributor_works_cache.stats['hits'] / contributor_works_lookups if contributor_works_lookups > 0 else 0,
+		'agent_labels': agent_label_stats['hits'] / agent_label_lookups if agent_label_lookups > 0 else 0
+	}
+	if response_cache:
+		hit_rates['responses'] = response_cache.getHitRatio()
+	return hit_rates
+
+# Counts kept by each of the run's caches and by the other parts of the script that keep their own
+def getComponentStats():
+	with rate_limiter.lock:
+		rate_limits = { host: dict(host_stats) for host, host_stats in rate_limiter.stats.items() }
+	stats = {
+		'caches': {
+			'candidate_features': dict(feature_cache.stats),
+			'contributor_works': dict(contributor_works_cache.stats),
+			'agent_labels': dict(agent_label_stats),
+			'requests': dict(request_coalescer.stats)
+		},
+		'cache_hit_rates': getCacheHitRates(),
+		'candidate_pruning': dict(candidate_pruner.stats),
+		'early_exit': dict(early_exit.stats),
+		'edit_distances': getDistanceStats(),
+		'rate_limits': rate_limits,
+		'connections': getConnectionStats(http_session)
+	}
+	if response_cache:
+		stats['caches']['responses'] = dict(response_cache.stats)
+	return stats
+
+metrics_enabled = True
+metrics_interval = 60
+metrics_prometheus = False
+
+# Writes the run's metrics next to its spreadsheet, as JSON and, optionally, as a Prometheus
+# textfile for node_exporter's textfile collector. The files are rewritten every interval while
+# the run goes on, and once more when it ends, each time by replacing the previous file so
+# that a reader never sees one half written.
+class MetricsReport:
+	PROMETHEUS_PREFIX = 'reconcile_works'
+
+	def __init__(self,output_path,interval,prometheus):
+		self.json_path = f"{output_path}_metrics.json"
+		self.prometheus_path = f"{output_path}_metrics.prom" if prometheus else None
+		self.interval = interval
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		if self.interval > 0:
+			self.thread = threading.Thread(target=self.run,name='Metrics',daemon=True)
+			self.thread.start()
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			self.write(False)
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread:
+			self.thread.join()
+		self.write(True)
+
+	def getReport(self,complete):
+		report = { 'complete': complete, 'started': datetime.datetime.fromtimestamp(run_metrics.started).isoformat(), 'seconds': time.time() - run_metrics.started }
+		report.update(run_metrics.snapshot())
+		report.update(getComponentStats())
+		return report
+
+	def write(self,complete):
+		logger = logging.getLogger('reconciliation_logger')
+		try:
+			report = self.getReport(complete)
+			self.replace(self.json_path,json.dumps(report,indent='\t'))
+			if self.prometheus_path:
+				self.replace(self.prometheus_path,self.formatPrometheus(report))
+		except Exception as e:
+			logger.warning(f"Could not write metrics: {e}")
+
+	def replace(self,path,text):
+		with open(f"{path}.tmp",'w') as metrics_file:
+			metrics_file.write(text)
+		os.replace(f"{path}.tmp",path)
+
+	def formatLabels(self,labels):
+		if len(labels) == 0:
+			return ''
+		escaped = [(name, str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')) for name, value in labels.items()]
+		return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+	def formatPrometheus(self,report):
+		metrics = collections.defaultdict(list)
+		metrics[('run_seconds','gauge')].append(({},report['seconds']))
+		metrics[('run_complete','gauge')].append(({},int(report['complete'])))
+		for name, entries in report['timings'].items():
+			for entry in entries:
+				labels = { 'stage': name }
+				labels.update({ label: value for label, value in entry.items() if label not in ['calls','seconds','max_seconds'] })
+				metrics[('stage_seconds_total','counter')].append((labels,entry['seconds']))
+				metrics[('stage_calls_total','counter')].append((labels,entry['calls']))
+				metrics[('stage_max_seconds','gauge')].append((labels,entry['max_seconds']))
+		for name, entries in report['counters'].items():
+			for entry in entries:
+				metrics[(f"{name}_total",'counter')].append(({ label: value for label, value in entry.items() if label != 'value' },entry['value']))
+		for cache, cache_stats in report['caches'].items():
+			for event, value in cache_stats.items():
+				metrics[('cache_events_total','counter')].append(({ 'cache': cache, 'event': event },value))
+		for outcome, value in report['edit_distances'].items():
+			metrics[('edit_distances_total','counter')].append(({ 'outcome': outcome },value))
+		for cache, hit_rate in report['cache_hit_rates'].items():
+			metrics[('cache_hit_rate','gauge')].append(({ 'cache': cache },hit_rate))
+		for host, host_stats in report['rate_limits'].items():
+			metrics[('rate_limit_wait_seconds_total','counter')].append(({ 'host': host, 'reason': 'limit' },host_stats['limit_wait']))
+			metrics[('rate_limit_wait_seconds_total','counter')].append(({ 'host': host, 'reason': 'pause' },host_stats['pause_wait']))
+			metrics[('throttled_total','counter')].append(({ 'host': host },host_stats['throttled']))
+
+		lines = []
+		for (name, metric_type), samples in metrics.items():
+			lines.append(f"# TYPE {self.PROMETHEUS_PREFIX}_{name} {metric_type}")
+			lines += [f"{self.PROMETHEUS_PREFIX}_{name}{self.formatLabels(labels)} {value}" for labels, value in samples]
+		return '\n'.join(lines) + '\n'
+
+# Reconcile each Work from `works`, an iterable of (Work, context) pairs, and pass the result
+# to finish(work, context, reconciliation) in the same order the Works came in. A Work of None
+# is passed straight through with a reconciliation of None. Works already reconciled in the
+# journal get their recorded reconciliation, and every new one is added to the journal once
+# it has been passed on.
+#
+# With more than one worker, searches run on a pool of threads, but results are still handed
+# over one at a time, as the oldest outstanding Work finishes. Only a few Works per thread are
+# queued up at once so that match fields and streamed elements don't pile up, unless the
+# scheduler holds on to a window of them to reorder.
+def processWorks(works,source,workers,cache_connection,journal,finish):
+	# Works may be reconciled out of order, so results are held until every Work before them
+	# has been finished
+	finished = {}
+	next_sequence = 0
+	def complete(sequence,work,context,reconciliation,replayed):
+		nonlocal next_sequence
+		finished[sequence] = (work, context, reconciliation, replayed)
+		while next_sequence in finished:
+			work, context, reconciliation, replayed = finished.pop(next_sequence)
+			finish(work,context,reconciliation)
+			if reconciliation and not replayed:
+				journal.record(reconciliation)
+			if reconciliation:
+				run_metrics.count('works',outcome='replayed' if replayed else 'reconciled')
+				if reconciliation['work_uri']:
+					run_metrics.count('matches',record='work')
+				if reconciliation['hub_uri']:
+					run_metrics.count('matches',record='hub')
+			next_sequence += 1
+
+	def prepare():
+		for sequence, (work, context) in enumerate(works):
+			replayed = journal.getCompleted(work) if work is not None else None
+			work_fields = getMatchFields(work,source) if work is not None and not replayed else None
+			yield sequence, work, context, replayed, work_fields
+
+	prepared_works = work_scheduler.schedule(prepare())
+	if source == Sources.wikidata and wikidata_chunk_size > 1:
+		prepared_works = prefetchWikidataContributors(prepared_works,cache_connection)
+
+	if workers > 1:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=workers,thread_name_prefix='reconcile') as executor:
+			pending = collections.deque()
+			for sequence, work, context, replayed, work_fields in prepared_works:
+				if work_fields:
+					future = executor.submit(reconcileWork,*work_fields,source,cache_connection)
+				else:
+					future = None
+				pending.append((sequence, work, context, future, replayed))
 
-			search_titles = [work_title_text]
-			if variant_titles_text:
-				search_titles += variant_titles_text
+				if len(pending) >= workers * 4:
+					pending_sequence, pending_work, pending_context, future, replayed = pending.popleft()
+					complete(pending_sequence,pending_work,pending_context,future.result() if future else replayed,replayed)
 
-			if args.source == Sources.loc:
-				notes = work.xpath("./bf:note/bf:Note", namespaces={ "bf": Namespaces.BF })
+			while pending:
+				pending_sequence, pending_work, pending_context, future, replayed = pending.popleft()
+				complete(pending_sequence,pending_work,pending_context,future.result() if future else replayed,replayed)
+	else:
+		for sequence, work, context, replayed, work_fields in prepared_works:
+			if work_fields:
+				complete(sequence,work,context,reconcileWork(*work_fields,source,cache_connection),replayed)
+			else:
+				complete(sequence,work,context,replayed,replayed)
+
+output_compress = False
+output_flush_interval = 10
+
+# The spreadsheet and output XML are written through a large buffer, which is flushed once
+# flush_interval seconds have passed since the last flush, so that the rows and elements written
+# so far can be read while a long run goes on. With compression on, files are gzipped and get a
+# .gz extension. Each flush ends a deflate block, so what has been written can be decompressed
+# before the file is finished.
+class OutputFile:
+	BUFFER_SIZE = 1048576
+
+	def __init__(self,path,text,compress,flush_interval):
+		self.path = f"{path}.gz" if compress else path
+		self.flush_interval = flush_interval
+		self.last_flush = time.monotonic()
+		self.raw_file = open(self.path,'wb',buffering=self.BUFFER_SIZE)
+		binary_file = gzip.GzipFile(fileobj=self.raw_file,mode='wb') if compress else self.raw_file
+		self.file = io.TextIOWrapper(binary_file) if text else binary_file
+
+	def write(self,data):
+		written = self.file.write(data)
+		if time.monotonic() - self.last_flush >= self.flush_interval:
+			self.file.flush()
+			self.last_flush = time.monotonic()
+		return written
+
+	def close(self):
+		self.file.close()
+		self.raw_file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*exc_info):
+		self.close()
+
+# Writes the top level elements of a document one at a time. Each element is serialized inside
+# an empty copy of the root, so namespaces are declared once on the root and the output has
+# the same layout as serializing the whole tree at once.
+class XMLStreamWriter:
+	def __init__(self,output_file,root):
+		self.output_file = output_file
+		self.shell = etree.Element(root.tag,attrib=dict(root.attrib),nsmap=root.nsmap)
+		self.closing_tag = None
+
+	@timed('output',format='xml')
+	def write(self,element):
+		self.shell.append(element)
+		serialized = etree.tostring(self.shell,pretty_print=True)
+		self.shell.remove(element)
+
+		start = serialized.index(b'>') + 1
+		end = serialized.rindex(b'</')
+		if self.closing_tag is None:
+			self.output_file.write(serialized[:start] + b'\n')
+			self.closing_tag = serialized[end:]
+		self.output_file.write(serialized[start+1:end])
+
+	@timed('output',format='xml')
+	def close(self):
+		if self.closing_tag is None:
+			self.output_file.write(etree.tostring(self.shell,pretty_print=True))
+		else:
+			self.output_file.write(self.closing_tag)
+
+# Read the document's root element without parsing the rest of the file
+def getRootElement(input_file):
+	for event, element in etree.iterparse(input_file,events=('start',)):
+		return element
+
+# Parse a document incrementally and yield each child of the root once it has been fully read.
+# The caller is responsible for detaching each element from the root once it is done with it,
+# which is what keeps memory bounded.
+def iterateTopLevelElements(input_file):
+	for event, element in etree.iterparse(input_file,events=('end',),remove_blank_text=True):
+		parent = element.getparent()
+		if parent is not None and parent.getparent() is None:
+			yield element
+
+# Group each top level Work with the elements that follow it up to the next Work. This is
+# how marc2bibframe2 lays out a record (the Work, then its Instances and Items), so the
+# Instances that need to point at a reconciled Work are all in the same group. Anything
+# before the first Work is yielded as a group without a Work.
+def iterateWorkGroups(input_file):
+	work_tag = f"{{{Namespaces.BF}}}Work"
+	work = None
+	group = []
+	for element in iterateTopLevelElements(input_file):
+		if element.tag == work_tag:
+			if work is not None or len(group) > 0:
+				yield work, group
+			work = element
+			group = [ element ]
+		else:
+			group.append(element)
 
-				languages = work.xpath("./bf:language/@rdf:resource", namespaces={ "bf": Namespaces.BF, "rdf": Namespaces.RDF })
+	if work is not None or len(group) > 0:
+		yield work, group
 
-				match_fields = { 'titles': search_titles, 'notes': notes, 'languages': languages, 'contributors': contributors }
-				
-				# Find best match for Work, and if that Work has any linked Hubs, add that to our list of Hubs to check
-				found_work_uri, found_work_title, found_work_associated_hubs = searchForRecordLOC(placeholder_work_id,match_fields,'http://id.loc.gov/resources/works',work_types,writer,cache_connection)
+# Look up URIs for contributor names, unless they were already recorded in the journal
+def resolveContributorNames(collect,journal,cache_connection):
+	if journal.name_mappings is not None:
+		return journal.name_mappings
 
-				if len(uniform_work_title) > 0:
-					match_fields['titles'] = uniform_work_title + match_fields['titles']
+	name_mappings = collect()
+	populateContributors(name_mappings,cache_connection)
+	journal.recordContributors(name_mappings)
+	return name_mappings
 
-				found_hub_uri, found_work_title, trash = searchForRecordLOC(placeholder_work_id,match_fields,'http://id.loc.gov/resources/hubs',['http://id.loc.gov/ontologies/bibframe/Work','http://id.loc.gov/ontologies/bibframe/Hub'],writer,cache_connection,found_work_uri,found_work_associated_hubs)
+def reconcileTree(args,cache_connection,output_writer,output_path,journal):
+	parser = etree.XMLParser(remove_blank_text=True)
+	tree = etree.parse(args.input, parser)
+	root = tree.getroot()
+	works = XPaths.WORKS(root)
+
+	index = DocumentIndex(root)
+
+	name_mappings = resolveContributorNames(lambda: collectContributorNames(index.contributions,{}),journal,cache_connection)
+	applyContributorNames(index.contributions,name_mappings)
+
+	def finish(work,context,reconciliation):
+		new_hub = applyReconciliation(work,index,reconciliation,output_writer)
+		if new_hub is not None:
+			root.append(new_hub)
+
+	processWorks(((work, None) for work in works),args.source,args.workers,cache_connection,journal,finish)
+
+	# Serialized straight to the file rather than to a copy of the whole document in memory
+	with OutputFile(output_path,False,output_compress,output_flush_interval) as out_xml_file, run_metrics.timer('output',format='xml'):
+		tree.write(out_xml_file,pretty_print=True)
+
+# Reconcile the input without ever holding the whole document in memory. A first pass
+# collects the contributor names so they can all be looked up together, as is done when
+# the whole tree is loaded. A second pass reconciles each Work along with the elements that
+# follow it, writes them out, and frees them. The output holds the same elements as the
+# output of reconcileTree, except that the Work for a found Hub follows the Work it was
+# found for instead of being gathered at the end of the document.
+def reconcileStream(args,cache_connection,output_writer,output_path,journal):
+	work_tag = f"{{{Namespaces.BF}}}Work"
+
+	def collect():
+		name_mappings = {}
+		for element in iterateTopLevelElements(args.input):
+			if element.tag == work_tag:
+				collectContributorNames(DocumentIndex([ element ]).contributions,name_mappings)
+			element.getparent().remove(element)
+		return name_mappings
+
+	name_mappings = resolveContributorNames(collect,journal,cache_connection)
+
+	def prepareWorks():
+		for work, group in iterateWorkGroups(args.input):
+			index = DocumentIndex(group)
+			applyContributorNames(index.contributions,name_mappings)
+			yield work, (group, index)
+
+	with OutputFile(output_path,False,output_compress,output_flush_interval) as out_xml_file:
+		xml_writer = XMLStreamWriter(out_xml_file,getRootElement(args.input))
+
+		def finish(work,context,reconciliation):
+			group, index = context
+			new_hub = None
+			if reconciliation:
+				new_hub = applyReconciliation(work,index,reconciliation,output_writer)
+
+			for element in group:
+				xml_writer.write(element)
+			if new_hub is not None:
+				xml_writer.write(new_hub)
+
+		processWorks(prepareWorks(),args.source,args.workers,cache_connection,journal,finish)
+		xml_writer.close()
 
-			elif args.source == Sources.wikidata:
-				match_fields = { 'titles': search_titles, 'contributors': contributors }
-				marc_keys = []
-				found_primary = False
-				for contributor in match_fields['contributors']:
-					contributor_labels = contributor.xpath("./bf:agent/bf:Agent/bflc:marcKey/text()",namespaces={"bf": Namespaces.BF,"bflc": Namespaces.BFLC})
+def reconcileWorks(args):
+	cache_connection = init(args)
+	logger = logging.getLogger('reconciliation_logger')
+	start_time = datetime.datetime.now()
 
-					contributor_types = contributor.xpath("./rdf:type/@rdf:resource",namespaces={"bf": Namespaces.BF,"rdf": Namespaces.RDF})
-					if 'http://id.loc.gov/ontologies/bibframe/PrimaryContribution' in contributor_types:
-						match_fields['contributors'] = contributor_labels
-						found_primary = True
-						break
-					else:
-						marc_keys += contributor_labels
+	output_path = f"{args.output}{SLASH}{args.input.rsplit('/',1)[1][:-4]}_{args.source}"
+	journal = ReconciliationJournal(f"{output_path}.journal",args.resume)
+	if args.resume:
+		logger.debug(f"Resuming with {len(journal.completed)} Works already reconciled")
 
-				if not found_primary:
-					match_fields['contributors'] = marc_keys
+	metrics_report = None
+	if metrics_enabled:
+		metrics_report = MetricsReport(output_path,metrics_interval,metrics_prometheus)
+		metrics_report.start()
 
-				found_work_uri, found_work_title = searchForRecordWiki(placeholder_work_id,match_fields,cache_connection,writer)
+	try:
+		with OutputFile(f"{output_path}.tsv",True,output_compress,output_flush_interval) as outfile:
+			writer = csv.writer(outfile,delimiter='\t')
 
-			# Make Instances point to new URI
-			if found_work_uri:
-				work.set('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about',found_work_uri)
-				instances = root.xpath(f"/rdf:RDF/bf:Instance[bf:instanceOf/@rdf:resource=\"{placeholder_work_id}\"]", namespaces={ "rdf": Namespaces.RDF, "bf": Namespaces.BF })
-				for instance in instances:
-					instance.xpath(f"./bf:instanceOf[@rdf:resource=\"{placeholder_work_id}\"]",namespaces={ "rdf": Namespaces.RDF, "bf": Namespaces.BF })[0].set(f"{{{Namespaces.RDF}}}resource",found_work_uri)
+			if args.stream:
+				reconcileStream(args,cache_connection,writer,f"{output_path}.xml",journal)
+			else:
+				reconcileTree(args,cache_connection,writer,f"{output_path}.xml",journal)
+	finally:
+		if metrics_report:
+			metrics_report.stop()
+		if response_cache:
+			response_cache.flushUsage()
+		work_tracer.close()
 
-			# Add a new Work for a found Hub that points back at the Work it was derived from
-			try:
-				if found_hub_uri:
-					expression_of = etree.SubElement(work,f"{{{Namespaces.BF}}}expressionOf")
-					expression_of.set(f"{{{Namespaces.RDF}}}resource",found_hub_uri)
-
-					new_hub = etree.SubElement(root,f"{{{Namespaces.BF}}}Work")
-					new_hub.set(f"{{{Namespaces.RDF}}}about",found_hub_uri)
-					hub_type = etree.SubElement(new_hub,f"{{{Namespaces.RDF}}}type")
-					hub_type.set(f"{{{Namespaces.RDF}}}resource","http://id.loc.gov/ontologies/bibframe/Hub")
-					hub_title = etree.SubElement(new_hub,f"{{{Namespaces.BF}}}title")
-					hub_Title = etree.SubElement(hub_title,f"{{{Namespaces.BF}}}Title")
-					hub_mainTitle = etree.SubElement(hub_Title,f"{{{Namespaces.BF}}}mainTitle")
-					hub_mainTitle.text = found_work_title
-					has_expression = etree.SubElement(new_hub,f"{{{Namespaces.BF}}}hasExpression")
-					has_expression.set(f"{{{Namespaces.RDF}}}resource", found_work_uri if found_work_uri else placeholder_work_id)
-			except UnboundLocalError:
-				logger.debug("Wikidata search does not support hubs")
-
-	with open(f"{args.output}{SLASH}{args.input.rsplit('/',1)[1][:-4]}_{args.source}.xml",'wb') as out_xml_file:
-		out_xml_file.write(etree.tostring(tree,pretty_print=True))
+	journal.close()
 
 	end_time = datetime.datetime.now()
 	logger.debug(f"Start time: {start_time}")
 	logger.debug(f"End time: {end_time}")
 	logger.debug(f"Run duration: {end_time-start_time}")
+	for host, host_stats in getConnectionStats(http_session).items():
+		logger.debug(f"Connections to {host}: {host_stats['connections']} opened for {host_stats['requests']} requests ({host_stats['reused']} reused)")
+	for host, host_stats in rate_limiter.stats.items():
+		logger.debug(f"Waiting on {host}: {host_stats['limit_wait']:.1f} seconds for the rate limit, {host_stats['pause_wait']:.1f} seconds paused after {host_stats['throttled']} 429 responses")
+	logger.debug(f"Requests shared or skipped within the run: {request_coalescer.stats}")
+	logger.debug(f"Candidate records fetched and pruned: {candidate_pruner.stats}")
+	logger.debug(f"Title searches skipped after a certain match: {early_exit.stats}")
+	logger.debug(f"Candidate record features: {feature_cache.stats}")
+	logger.debug(f"Wikidata contributor works: {contributor_works_cache.stats}")
+	logger.debug(f"Edit distances computed and ruled out by a lower bound: {getDistanceStats()}")
+	logger.debug(f"Cache hit rates with {work_scheduler.order} ordering: {', '.join(f'{cache} {hit_rate:.2%}' for cache, hit_rate in getCacheHitRates().items())}")
+	if response_cache:
+		logger.debug(f"Response cache: {response_cache.stats}")
+		logger.debug(f"Response cache hit ratio: {response_cache.getHitRatio():.2%}")
+	if work_tracer.trace_file:
+		logger.debug(f"Works traced: {work_tracer.stats['written']} written of {work_tracer.stats['sampled']} sampled")
+	logger.debug(f"Seconds spent in each stage: {', '.join(f'{stage} {seconds:.1f}' for stage, seconds in sorted(run_metrics.getTotals().items()))}")
+	if metrics_report:
+		logger.debug(f"Metrics written to {metrics_report.json_path}")
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
@@ -892,6 +2812,10 @@ if __name__ == '__main__':
 	parser.add_argument("output", help="Directory to write the output to")
 	parser.add_argument("source", type=Sources, choices=list(Sources), help="Run queries on LOC or Wikidata")
 	parser.add_argument("-v", "--verbose", action="store_true")
+	parser.add_argument("-w", "--workers", type=int, default=1, help="Number of Works to reconcile concurrently")
+	parser.add_argument("-s", "--stream", action="store_true", help="Process the input incrementally instead of loading it all into memory")
+	parser.add_argument("-r", "--resume", action="store_true", help="Continue an earlier run on the same input from its journal")
+	parser.add_argument("-c", "--catalog", type=Catalogs, choices=list(Catalogs), default=Catalogs.loc, help="Search id.loc.gov, or a local catalog built with loadLocalCatalog.py")
 	args = parser.parse_args()
 
 	reconcileWorks(args)
\ No newline at end of file